@@ -0,0 +1,89 @@
+import asyncio
+import multiprocessing
+import uuid
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+
+import extract_chinese_from_pdfs
+from instrumentation import profiler
+
+class JobCancelledError(Exception):
+    pass
+
+def convert_pdf_in_worker(pdf_path, output_directory, settings, job_id, shared_state):
+    """Runs in a worker process, so the settings of one job never leak into another."""
+    extract_chinese_from_pdfs.apply_settings(settings)
+    profiler.reset()
+
+    def on_progress(phrase_count):
+        if shared_state.get(('cancelled', job_id)):
+            raise JobCancelledError('The conversion was cancelled')
+        shared_state[job_id] = phrase_count
+
+    csv_file_path = asyncio.run(extract_chinese_from_pdfs.process_file_async(pdf_path, output_directory, on_progress))
+    return csv_file_path, profiler.snapshot()
+
+class JobRunner:
+    """Runs conversions in the background for the UI.
+
+    Every job is coordinated by a thread, while the conversion itself runs in a worker process.
+    A job is a plain dict (kept in the session state by the UI) that the coordinating thread
+    updates with the status, progress and result.
+    """
+    POLL_INTERVAL = 0.25
+
+    def __init__(self, max_workers):
+        self.processes = ProcessPoolExecutor(max_workers=max_workers)
+        self.threads = ThreadPoolExecutor(max_workers=max_workers * 4)
+        self.manager = multiprocessing.Manager()
+        self.shared_state = self.manager.dict()
+
+    @staticmethod
+    def create_job(name):
+        return {'id': uuid.uuid4().hex, 'name': name, 'status': 'queued', 'progress': 0, 'result': None, 'error': None}
+
+    def submit(self, job, function, *arguments):
+        """Runs function(*arguments) on a coordinating thread and stores its return value as the job result."""
+        def run():
+            try:
+                job['result'] = function(*arguments)
+                job['status'] = 'completed'
+            except (JobCancelledError, CancelledError):
+                job['status'] = 'cancelled'
+            except Exception as e:
+                job['status'] = 'cancelled' if job.get('cancelled') else 'failed'
+                job['error'] = str(e)
+
+        self.threads.submit(run)
+        return job
+
+    def run_pdf_conversion(self, job, pdf_path, output_directory, settings):
+        """Blocks until the PDF is converted, keeping job['progress'] up to date. Returns the CSV path."""
+        if job.get('cancelled'):
+            raise JobCancelledError('The conversion was cancelled')
+
+        future = self.processes.submit(convert_pdf_in_worker, pdf_path, output_directory, settings, job['id'], self.shared_state)
+        job['future'] = future
+        job['status'] = 'running'
+
+        try:
+            while True:
+                try:
+                    csv_file_path, profile_snapshot = future.result(timeout=JobRunner.POLL_INTERVAL)
+                    break
+                except TimeoutError:
+                    job['progress'] = self.shared_state.get(job['id'], job['progress'])
+
+            job['progress'] = self.shared_state.get(job['id'], job['progress'])
+            profiler.merge(profile_snapshot)
+            return csv_file_path
+        finally:
+            self.shared_state.pop(job['id'], None)
+            self.shared_state.pop(('cancelled', job['id']), None)
+
+    def cancel(self, job):
+        job['cancelled'] = True
+        self.shared_state[('cancelled', job['id'])] = True
+
+        future = job.get('future')
+        if future is not None:
+            future.cancel()
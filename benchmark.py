@@ -0,0 +1,424 @@
+import asyncio
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import extract_chinese_from_pdfs as extractor
+import generate_flashcards_from_csvs as flashcards
+from dictionary_index import DictionaryIndex
+from pinyin_engine import PinyinEngine
+from translation_scheduler import TranslationScheduler
+from wiktionary_client import WiktionaryClient
+
+# Synthetic input
+def generate_vocabulary(size, rng):
+    characters = [chr(code_point) for code_point in range(0x4E00, 0x9FA6)]
+    vocabulary = set()
+    while len(vocabulary) < size:
+        vocabulary.add(''.join(rng.choice(characters) for _ in range(rng.choice([1, 1, 2, 2, 2, 3]))))
+    return sorted(vocabulary)
+
+def generate_phrases(count, vocabulary, rng):
+    return [''.join(rng.choice(vocabulary) for _ in range(rng.randint(1, 3))) for _ in range(count)]
+
+def write_synthetic_pdf(file_path, pages):
+    """Writes a minimal PDF with one phrase per line, using an Identity-H CID font with a ToUnicode map
+    so that the text can be extracted again (the font itself is not embedded)."""
+    objects = []
+
+    def add_object(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog_id = add_object(None)
+    pages_id = add_object(None)
+
+    # Character codes are the code points, mapped back to themselves (at most 100 entries per block)
+    code_points = sorted({ord(char) for lines in pages for line in lines for char in line})
+    blocks = [code_points[i:i + 100] for i in range(0, len(code_points), 100)]
+    mappings = ''.join(
+        f'{len(block)} beginbfchar\n' + ''.join(f'<{code:04X}> <{code:04X}>\n' for code in block) + 'endbfchar\n'
+        for block in blocks)
+    cmap = (
+        '/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n'
+        '/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def\n'
+        '/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n'
+        '1 begincodespacerange\n<0000> <FFFF>\nendcodespacerange\n'
+        f'{mappings}'
+        'endcmap\nCMapName currentdict /CMap defineresource pop\nend\nend\n').encode('ascii')
+    to_unicode_id = add_object(b'<< /Length %d >>\nstream\n' % len(cmap) + cmap + b'\nendstream')
+    cid_font_id = add_object(
+        b'<< /Type /Font /Subtype /CIDFontType0 /BaseFont /STSong-Light '
+        b'/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> /DW 1000 >>')
+    font_id = add_object(
+        b'<< /Type /Font /Subtype /Type0 /BaseFont /STSong-Light /Encoding /Identity-H '
+        b'/DescendantFonts [%d 0 R] /ToUnicode %d 0 R >>' % (cid_font_id, to_unicode_id))
+
+    page_ids = []
+    for lines in pages:
+        text_lines = ''.join('<%s> Tj T*\n' % ''.join('%04X' % ord(char) for char in line) for line in lines)
+        content = ('BT /F1 12 Tf 50 800 Td 16 TL\n' + text_lines + 'ET').encode('ascii')
+        content_id = add_object(b'<< /Length %d >>\nstream\n' % len(content) + content + b'\nendstream')
+        page_ids.append(add_object(
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] '
+            b'/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>' % (pages_id, font_id, content_id)))
+
+    objects[catalog_id - 1] = b'<< /Type /Catalog /Pages %d 0 R >>' % pages_id
+    kids = ' '.join('%d 0 R' % page_id for page_id in page_ids).encode('ascii')
+    objects[pages_id - 1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(page_ids))
+
+    output = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for object_id, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n' % object_id + body + b'\nendobj\n'
+
+    xref_offset = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    output += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    output += b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, catalog_id, xref_offset)
+
+    with open(file_path, mode='wb') as file:
+        file.write(output)
+
+def write_synthetic_csv(file_path, row_count, vocabulary, rng):
+    with open(file_path, mode='w', newline='\n', encoding='utf-8-sig') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(['Text', 'Pinyin', 'Translation', 'Sub Phrase Of'])
+        for text in generate_phrases(row_count, vocabulary, rng):
+            parent = rng.choice(['', '', text + rng.choice(vocabulary)])
+            writer.writerow([text, ' '.join(f'p{ord(char):X}' for char in text), f'da:{text}', parent])
+
+# Fake backends
+class LatencyRecorder:
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        return {stage: summarize(samples) for stage, samples in sorted(self.samples.items())}
+
+class FakeServiceQuota:
+    """Server side request limit of a fake backend, requests above it are refused (like HTTP 429 with Retry-After)."""
+    RETRY_AFTER = 1
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.throttled = 0
+        # The fake Wiktionary server answers requests on several threads
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens < 1:
+                self.throttled += 1
+                return False
+            self.tokens -= 1
+            return True
+
+class FakeTranslation:
+    def __init__(self, text):
+        self.text = text
+
+class FakeTranslator:
+    """Deterministic stand-in for googletrans.Translator (one translation per line of the text)."""
+    HOST = 'translate.googleapis.com'
+
+    def __init__(self, latency, recorder, quota=None):
+        self.latency = latency
+        self.recorder = recorder
+        self.quota = quota
+
+    async def translate(self, text, dest='da'):
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        self.recorder.record('translation request', time.perf_counter() - start)
+        if self.quota is not None and not self.quota.allow():
+            # googletrans only reports the status code in the message of a plain Exception
+            raise Exception(f'Unexpected status code "429" from {FakeTranslator.HOST}')
+        return FakeTranslation('\n'.join(f'{dest}:{line}' for line in text.split('\n')))
+
+class FakeWiktionaryHandler(BaseHTTPRequestHandler):
+    """Answers the category queries of WiktionaryClient from the synthetic vocabulary, like the MediaWiki API."""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, which Nagle's algorithm would delay on a kept-alive connection
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        if server.quota is not None and not server.quota.allow():
+            self._send(429, b'', {'Retry-After': str(FakeServiceQuota.RETRY_AFTER)})
+            return
+
+        titles = parse_qs(urlparse(self.path).query).get('titles', [''])[0].split('|')
+        pages = [
+            {'title': title, 'categories': [{'title': WiktionaryClient.CHINESE_CATEGORIES[0]}]}
+            if title in server.vocabulary else {'title': title, 'missing': True}
+            for title in titles]
+        self._send(200, json.dumps({'batchcomplete': True, 'query': {'pages': pages}}).encode('utf-8'), {'Content-Type': 'application/json'})
+
+    def _send(self, status, body, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *arguments):
+        pass
+
+def start_fake_wiktionary_server(vocabulary, latency, quota=None, port=0):
+    """Serves the fake Wiktionary API on a background thread, returns the server (see get_api_url)."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeWiktionaryHandler)
+    server.daemon_threads = True
+    server.vocabulary = set(vocabulary)
+    server.latency = latency
+    server.quota = quota
+    threading.Thread(target=server.serve_forever, name='fake-wiktionary', daemon=True).start()
+    return server
+
+def get_api_url(server):
+    return f'http://127.0.0.1:{server.server_address[1]}/w/api.php'
+
+class TimedWiktionaryClient(WiktionaryClient):
+    """The real client (status codes, Retry-After and retries included), recording the latency of every request."""
+
+    def __init__(self, api_url, recorder):
+        super().__init__(api_url)
+        self.recorder = recorder
+
+    def _get(self, parameters):
+        start = time.perf_counter()
+        try:
+            return super()._get(parameters)
+        finally:
+            self.recorder.record('dictionary request', time.perf_counter() - start)
+
+# Measuring
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summarize(samples):
+    values = sorted(samples)
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 0.50) * 1000,
+        'p90_ms': percentile(values, 0.90) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'max_ms': (values[-1] if values else 0.0) * 1000,
+    }
+
+def count_csv_rows(csv_path):
+    with open(csv_path, mode='r', encoding='utf-8-sig') as file:
+        return sum(1 for _ in file) - 1
+
+def measure_seconds(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+def measure_peak_memory(function):
+    # Tracing slows everything down considerably, so it is kept out of the timed runs
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def install_fake_backends(vocabulary, options, recorder):
+    translation_quota = wiktionary_quota = None
+    if options['throttle'] is not None:
+        translation_quota = FakeServiceQuota(options['throttle'])
+        wiktionary_quota = FakeServiceQuota(options['throttle'])
+
+    extractor.translation_scheduler = TranslationScheduler(lambda: FakeTranslator(options['translation_latency'], recorder, translation_quota))
+    wiktionary_server = start_fake_wiktionary_server(vocabulary, options['dictionary_latency'], wiktionary_quota)
+    extractor.wiktionary_client = TimedWiktionaryClient(get_api_url(wiktionary_server), recorder)
+    extractor.cache_store = None
+    extractor.csv_cache.translations.clear()
+    extractor.csv_cache.pinyin.clear()
+    extractor.pinyin_engine = PinyinEngine()
+    extractor.echo_csv_lines = False
+    TranslationScheduler.CONCURRENCY = options['concurrency']
+
+    original_iter_pdf_pages_text = extractor.iter_pdf_pages_text
+
+    def timed_iter_pdf_pages_text(pdf_path):
+        pages_text = original_iter_pdf_pages_text(pdf_path)
+        while True:
+            start = time.perf_counter()
+            page_text = next(pages_text, None)
+            if page_text is None:
+                return
+            recorder.record('pdf page', time.perf_counter() - start)
+            yield page_text
+
+    original_create = extractor.ChinesePhrase.create_with_sub_phrases_async
+
+    async def timed_create_with_sub_phrases_async(phrase):
+        start = time.perf_counter()
+        instance = await original_create(phrase)
+        recorder.record('phrase enrichment', time.perf_counter() - start)
+        return instance
+
+    extractor.iter_pdf_pages_text = timed_iter_pdf_pages_text
+    extractor.ChinesePhrase.create_with_sub_phrases_async = staticmethod(timed_create_with_sub_phrases_async)
+    return {'translation': translation_quota, 'wiktionary': wiktionary_quota}, wiktionary_server
+
+def run_benchmark(options):
+    rng = random.Random(options['seed'])
+    vocabulary = generate_vocabulary(options['vocabulary'], rng)
+    recorder = LatencyRecorder()
+    quotas, wiktionary_server = install_fake_backends(vocabulary, options, recorder)
+
+    if options['dictionary']:
+        extractor.dictionary = DictionaryIndex(vocabulary)
+        extractor.ChinesePhrase.SUB_PHRASE_LIMIT = None
+
+    with tempfile.TemporaryDirectory() as directory:
+        pdf_path = os.path.join(directory, 'synthetic.pdf')
+        pages = [generate_phrases(options['phrases_per_page'], vocabulary, rng) for _ in range(options['pages'])]
+        write_synthetic_pdf(pdf_path, pages)
+
+        def run_extraction():
+            # Every run starts cold, so the timed run does not reuse the translations of the memory run
+            extractor.ChinesePhrase.STORE.clear()
+            extractor.csv_cache.translations.clear()
+            return asyncio.run(extractor.process_file_async(pdf_path, os.path.join(directory, 'csv')))
+
+        large_csv_path = os.path.join(directory, 'synthetic.csv')
+        write_synthetic_csv(large_csv_path, options['csv_rows'], vocabulary, rng)
+
+        def run_flashcards():
+            return flashcards.process_file(large_csv_path, os.path.join(directory, 'txt'))
+
+        extraction_memory = flashcard_memory = None
+        if options['memory']:
+            extraction_memory = measure_peak_memory(run_extraction)
+            flashcard_memory = measure_peak_memory(run_flashcards)
+            recorder.samples.clear()
+
+        csv_path, extraction_seconds = measure_seconds(run_extraction)
+        extraction_rows = count_csv_rows(csv_path)
+        _, flashcard_seconds = measure_seconds(run_flashcards)
+    wiktionary_server.shutdown()
+
+    phrase_count = options['pages'] * options['phrases_per_page']
+    return {
+        'options': options,
+        'extraction': {
+            'phrases': phrase_count,
+            'csv_rows': extraction_rows,
+            'seconds': extraction_seconds,
+            'phrases_per_second': phrase_count / extraction_seconds,
+            'peak_memory_bytes': extraction_memory,
+        },
+        'flashcards': {
+            'csv_rows': options['csv_rows'],
+            'seconds': flashcard_seconds,
+            'rows_per_second': options['csv_rows'] / flashcard_seconds,
+            'peak_memory_bytes': flashcard_memory,
+        },
+        'stages': recorder.summary(),
+        'services': {
+            'translation': {
+                'throttled': quotas['translation'].throttled if quotas['translation'] else 0,
+                'final_rate': extractor.translation_scheduler.guard.limiter.rate,
+            },
+            'wiktionary': {
+                'throttled': quotas['wiktionary'].throttled if quotas['wiktionary'] else 0,
+                'final_rate': extractor.wiktionary_client.guard.limiter.rate,
+            },
+        },
+    }
+
+def format_memory(peak_memory_bytes):
+    return 'not measured' if peak_memory_bytes is None else f'{peak_memory_bytes / 1024 / 1024:.1f} MiB'
+
+def print_report(report):
+    extraction = report['extraction']
+    print(f"\nprocess_file_async: {extraction['phrases']} phrases ({extraction['csv_rows']} rows) in {extraction['seconds']:.2f}s, "
+          f"{extraction['phrases_per_second']:.1f} phrases/s, peak memory {format_memory(extraction['peak_memory_bytes'])}")
+
+    flashcard = report['flashcards']
+    print(f"process_file (flashcards): {flashcard['csv_rows']} rows in {flashcard['seconds']:.2f}s, "
+          f"{flashcard['rows_per_second']:.0f} rows/s, peak memory {format_memory(flashcard['peak_memory_bytes'])}")
+
+    print(f"\n{'Stage':<22}{'Count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, summary in report['stages'].items():
+        print(f"{stage:<22}{summary['count']:>8}{summary['p50_ms']:>10.2f}{summary['p90_ms']:>10.2f}{summary['p99_ms']:>10.2f}{summary['max_ms']:>10.2f}")
+
+    print(f"\n{'Service':<22}{'Throttled':>10}{'Final rate/s':>14}")
+    for service, summary in report['services'].items():
+        print(f"{service:<22}{summary['throttled']:>10}{summary['final_rate']:>14.1f}")
+
+def get_option_value(option, default, parse=int):
+    if option not in sys.argv:
+        return default
+
+    option_index = sys.argv.index(option) + 1
+    try:
+        return parse(sys.argv[option_index])
+    except (IndexError, ValueError):
+        print(f'Please provide a valid value for {option}')
+        sys.exit(1)
+
+if __name__ == "__main__":
+    options = {
+        'pages': get_option_value('--pages', 20),
+        'phrases_per_page': get_option_value('--phrases-per-page', 40),
+        'vocabulary': get_option_value('--vocabulary', 2000),
+        'csv_rows': get_option_value('--csv-rows', 100000),
+        'translation_latency': get_option_value('--translation-latency', 50, float) / 1000,
+        'dictionary_latency': get_option_value('--dictionary-latency', 80, float) / 1000,
+        'concurrency': get_option_value('--concurrency', TranslationScheduler.CONCURRENCY),
+        'dictionary': '--dictionary' in sys.argv,
+        'memory': '--skip-memory' not in sys.argv,
+        'seed': get_option_value('--seed', 42),
+        'throttle': get_option_value('--throttle', None, float),
+    }
+
+    if '--serve-wiktionary' in sys.argv:
+        # Only the fake Wiktionary API, e.g. for extract_chinese_from_pdfs.py --wiktionary-api-url
+        quota = FakeServiceQuota(options['throttle']) if options['throttle'] is not None else None
+        vocabulary = generate_vocabulary(options['vocabulary'], random.Random(options['seed']))
+        server = start_fake_wiktionary_server(vocabulary, options['dictionary_latency'], quota, get_option_value('--serve-wiktionary', 0))
+        print(f"Fake Wiktionary API listening on {get_api_url(server)}, stop with Ctrl+C")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        server.shutdown()
+        if quota is not None:
+            print(f"Throttled {quota.throttled} requests")
+        sys.exit(0)
+
+    report = run_benchmark(options)
+    print_report(report)
+
+    if '--json' in sys.argv:
+        json_path = get_option_value('--json', None, str)
+        with open(json_path, mode='w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        print(f"\nReport written to {json_path}")
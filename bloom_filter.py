@@ -0,0 +1,226 @@
+import hashlib
+import math
+import mmap
+import os
+import random
+import struct
+import threading
+from instrumentation import profiler
+
+HEADER = struct.Struct('<8sQQQQ')
+HEADER_SIZE = 64
+MAGIC = b'CNBLOOM2'
+
+# All bits of a text are set in one block, so a lookup reads 64 bytes instead of one byte per hash
+BLOCK_BYTES = 64
+BLOCK_BITS = BLOCK_BYTES * 8
+
+class BloomFilter:
+    """A blocked Bloom filter backed by a memory-mapped file, so it is loaded instantly and shared by processes.
+
+    Sized for capacity texts at about the given false positive rate. Texts can only be added, and
+    membership tests may wrongly answer yes (at about the false positive rate) but never wrongly no.
+    """
+
+    def __init__(self, file_path, capacity=None, false_positive_rate=None):
+        """Opens the filter at file_path, creating it with the given capacity and false positive rate if it does not exist."""
+        self.file_path = file_path
+        if not os.path.exists(file_path):
+            BloomFilter.create(file_path, capacity, false_positive_rate)
+
+        self.file = open(file_path, mode='r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.block_count, self.hash_count, self.capacity, _ = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or len(self.map) < HEADER_SIZE + self.block_count * BLOCK_BYTES:
+            self.close()
+            raise ValueError(f'{file_path} is not a Bloom filter')
+
+        # A 64 bit block hash and a 16 bit position per hash, all from one digest
+        self.digest_format = struct.Struct(f'<Q{self.hash_count}H')
+
+    @staticmethod
+    def create(file_path, capacity, false_positive_rate):
+        capacity = max(1, capacity)
+        # Blocks fill unevenly, which a 20% larger filter makes up for
+        bit_count = 1.2 * -capacity * math.log(false_positive_rate) / math.log(2) ** 2
+        block_count = max(1, math.ceil(bit_count / BLOCK_BITS))
+        hash_count = min(16, max(1, round(block_count * BLOCK_BITS / capacity * math.log(2))))
+
+        with open(file_path, mode='wb') as file:
+            file.write(HEADER.pack(MAGIC, block_count, hash_count, capacity, 0).ljust(HEADER_SIZE, b'\0'))
+            file.truncate(HEADER_SIZE + block_count * BLOCK_BYTES)
+
+    def _locate(self, text):
+        """Returns the offset of the block of text and the positions of its bits (modulo BLOCK_BITS) in that block."""
+        block_hash, *positions = self.digest_format.unpack(hashlib.blake2b(text.encode('utf-8'), digest_size=self.digest_format.size).digest())
+        return HEADER_SIZE + block_hash % self.block_count * BLOCK_BYTES, positions
+
+    @property
+    def count(self):
+        return HEADER.unpack_from(self.map, 0)[4]
+
+    def add(self, text):
+        offset, positions = self._locate(text)
+        block = bytearray(self.map[offset:offset + BLOCK_BYTES])
+        for position in positions:
+            position &= BLOCK_BITS - 1
+            block[position >> 3] |= 1 << (position & 7)
+        self.map[offset:offset + BLOCK_BYTES] = block
+        HEADER.pack_into(self.map, 0, MAGIC, self.block_count, self.hash_count, self.capacity, self.count + 1)
+
+    def __contains__(self, text):
+        offset, positions = self._locate(text)
+        block = self.map[offset:offset + BLOCK_BYTES]
+        for position in positions:
+            position &= BLOCK_BITS - 1
+            if not block[position >> 3] >> (position & 7) & 1:
+                return False
+        return True
+
+    def estimated_false_positive_rate(self):
+        # Ignores the uneven filling of the blocks, so the actual rate is a little higher
+        bit_count = self.block_count * BLOCK_BITS
+        return (1 - math.exp(-self.hash_count * self.count / bit_count)) ** self.hash_count
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class EntryFilter:
+    """Answers dictionary lookups that were made before without asking the cache store or the network.
+
+    Confirmed entries are kept as an exact set (loaded from the cache store), confirmed non entries
+    in a Bloom filter persisted next to the cache store. As entries are checked first, a false
+    positive of the filter can only reject a text that was never looked up (at about
+    FALSE_POSITIVE_RATE). The filter is rebuilt twice as large once it holds more than its capacity.
+    """
+    FALSE_POSITIVE_RATE = 0.001
+    MIN_CAPACITY = 10000
+
+    def __init__(self, file_path, cache_store):
+        self.file_path = file_path
+        self.cache_store = cache_store
+        self.entries = None
+        self.non_entries = None
+        self.auto_rebuild = True
+        # Segmentation looks texts up from several threads, and a rebuild replaces the map
+        self.lock = threading.Lock()
+
+    def _load(self):
+        self.entries = set(self.cache_store.iter_dictionary_entries(True))
+        try:
+            self.non_entries = BloomFilter(self.file_path) if os.path.exists(self.file_path) else None
+        except (OSError, ValueError):
+            self.non_entries = None
+        if self.non_entries is None:
+            self._rebuild()
+
+    def get(self, text):
+        """Returns True or False for a text looked up before, None if it is unknown."""
+        with self.lock:
+            if self.entries is None:
+                self._load()
+
+            if text in self.entries:
+                has_entry = True
+            elif self.non_entries is not None and text in self.non_entries:
+                has_entry = False
+            else:
+                profiler.count('cache.entry_filter.miss')
+                return None
+
+        profiler.count('cache.entry_filter.hit')
+        return has_entry
+
+    def add(self, text, has_entry):
+        """Records a lookup (which must also have been written to the cache store)."""
+        with self.lock:
+            if self.entries is None:
+                self._load()
+
+            if has_entry:
+                self.entries.add(text)
+                return
+
+            # Without a filter (it could not be built), non entries are only kept in the cache store
+            if self.non_entries is None or text in self.non_entries:
+                return
+            self.non_entries.add(text)
+            if self.auto_rebuild and self.non_entries.count > self.non_entries.capacity:
+                self._rebuild()
+
+    def rebuild(self):
+        """Recreates the filter from the non entries in the cache store (e.g. after pruning), returns their number."""
+        with self.lock:
+            if self.entries is None:
+                self.entries = set(self.cache_store.iter_dictionary_entries(True))
+            return self._rebuild()
+
+    def _rebuild(self):
+        """Replaces the filter with one built from the non entries in the cache store, returns their number.
+
+        Processes sharing the filter may rebuild it at the same time, the last one to finish wins.
+        If the filter cannot be rebuilt, the old one (if any) stays in use and automatic rebuilds
+        stop, as lookups then only fall back to the cache store more often.
+        """
+        non_entries = self.cache_store.iter_dictionary_entries(False)
+        temporary_file_path = f'{self.file_path}.{os.getpid()}.tmp'
+        try:
+            BloomFilter.create(temporary_file_path, max(EntryFilter.MIN_CAPACITY, 2 * len(non_entries)), EntryFilter.FALSE_POSITIVE_RATE)
+            bloom_filter = BloomFilter(temporary_file_path)
+            for text in non_entries:
+                bloom_filter.add(text)
+            bloom_filter.close()
+
+            # Windows does not replace a mapped file. Other processes keep using the filter they mapped until they open it again
+            if self.non_entries is not None:
+                self.non_entries.close()
+                self.non_entries = None
+            os.replace(temporary_file_path, self.file_path)
+        except OSError as e:
+            print(f"Could not rebuild the Bloom filter {self.file_path}: {e}")
+            self.auto_rebuild = False
+            if os.path.exists(temporary_file_path):
+                try:
+                    os.remove(temporary_file_path)
+                except OSError:
+                    pass
+
+        if self.non_entries is None:
+            try:
+                self.non_entries = BloomFilter(self.file_path) if os.path.exists(self.file_path) else None
+            except (OSError, ValueError):
+                self.non_entries = None
+        return len(non_entries)
+
+    def report(self, sample_size=10000, seed=0):
+        """Returns the size of the filter with its estimated and measured false positive rates.
+
+        The measured rate is the share of random texts of 2 to 4 CJK characters, none of which
+        were ever looked up, that the filter would reject.
+        """
+        with self.lock:
+            if self.entries is None:
+                self._load()
+        if self.non_entries is None:
+            raise ValueError(f'The Bloom filter {self.file_path} could not be built')
+
+        rng = random.Random(seed)
+        false_positives = tested = 0
+        while tested < sample_size:
+            text = ''.join(chr(rng.randint(0x4E00, 0x9FFF)) for _ in range(rng.randint(2, 4)))
+            if text in self.entries or self.cache_store.get_dictionary_entry(text) is not None:
+                continue
+            tested += 1
+            false_positives += text in self.non_entries
+
+        return {
+            'file_path': self.file_path,
+            'entries': len(self.entries),
+            'non_entries': self.non_entries.count,
+            'capacity': self.non_entries.capacity,
+            'size_bytes': os.path.getsize(self.file_path),
+            'hash_count': self.non_entries.hash_count,
+            'estimated_false_positive_rate': self.non_entries.estimated_false_positive_rate(),
+            'measured_false_positive_rate': false_positives / sample_size,
+        }
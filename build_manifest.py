@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+
+MANIFEST_FILE_NAME = '.manifest.json'
+
+def hash_file(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, mode='rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def hash_settings(settings):
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+class BuildManifest:
+    """Records the content hash and settings every output in a directory was built from.
+
+    Used by the --incremental mode of both CLIs to skip inputs whose outputs are already up to date.
+    """
+
+    def __init__(self, output_directory):
+        self.file_path = os.path.join(output_directory, MANIFEST_FILE_NAME)
+        self.entries = {}
+
+        if os.path.exists(self.file_path):
+            with open(self.file_path, mode='r', encoding='utf-8') as file:
+                self.entries = json.load(file)
+
+    def _hash_input(self, input_path, entry):
+        # Unchanged size and modification time means unchanged content, so the file is not read again
+        stat = os.stat(input_path)
+        if entry is not None and entry['size'] == stat.st_size and entry['modified'] == stat.st_mtime:
+            return entry['input_hash']
+        return hash_file(input_path)
+
+    def is_up_to_date(self, input_path, output_path, settings):
+        entry = self.entries.get(os.path.abspath(input_path))
+        if entry is None or not os.path.exists(output_path):
+            return False
+
+        return entry['output_path'] == os.path.abspath(output_path) \
+            and entry['settings_hash'] == hash_settings(settings) \
+            and entry['input_hash'] == self._hash_input(input_path, entry)
+
+    def record(self, input_path, output_path, settings):
+        key = os.path.abspath(input_path)
+        stat = os.stat(input_path)
+        self.entries[key] = {
+            'input_hash': self._hash_input(input_path, self.entries.get(key)),
+            'size': stat.st_size,
+            'modified': stat.st_mtime,
+            'output_path': os.path.abspath(output_path),
+            'settings_hash': hash_settings(settings),
+        }
+
+    def save(self):
+        directory = os.path.dirname(self.file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        temporary_file_path = self.file_path + '.tmp'
+        with open(temporary_file_path, mode='w', encoding='utf-8') as file:
+            json.dump(self.entries, file, indent=2, sort_keys=True)
+        os.replace(temporary_file_path, self.file_path)
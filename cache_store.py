@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS translations (
+    text TEXT NOT NULL,
+    language TEXT NOT NULL,
+    translation TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (text, language)
+);
+CREATE TABLE IF NOT EXISTS dictionary_entries (
+    text TEXT PRIMARY KEY,
+    has_entry INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pinyin (
+    text TEXT PRIMARY KEY,
+    pinyin TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+TABLES = ['translations', 'dictionary_entries', 'pinyin']
+
+class CacheStore:
+    """Persistent cache of translations, dictionary lookups and pinyin overrides.
+
+    Backed by SQLite in WAL mode, so several processes can read and write the same file at once.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+    def _connect(self):
+        # Connections must not be shared with forked worker processes
+        if self.connection is not None and self.pid == os.getpid():
+            return self.connection
+
+        self.connection = sqlite3.connect(self.file_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.pid = os.getpid()
+        return self.connection
+
+    def _fetch_one(self, query, parameters):
+        with self.lock:
+            row = self._connect().execute(query, parameters).fetchone()
+        return row[0] if row else None
+
+    def _execute(self, query, parameters=()):
+        with self.lock:
+            return self._connect().execute(query, parameters)
+
+    def get_translation(self, text, language):
+        return self._fetch_one('SELECT translation FROM translations WHERE text = ? AND language = ?', (text, language))
+
+    def set_translation(self, text, language, translation):
+        self._execute(
+            'INSERT OR REPLACE INTO translations (text, language, translation, updated_at) VALUES (?, ?, ?, ?)',
+            (text, language, translation, time.time()))
+
+    def get_dictionary_entry(self, text):
+        has_entry = self._fetch_one('SELECT has_entry FROM dictionary_entries WHERE text = ?', (text,))
+        return None if has_entry is None else bool(has_entry)
+
+    def set_dictionary_entry(self, text, has_entry):
+        self._execute(
+            'INSERT OR REPLACE INTO dictionary_entries (text, has_entry, updated_at) VALUES (?, ?, ?)',
+            (text, int(has_entry), time.time()))
+
+    def iter_dictionary_entries(self, has_entry):
+        """Returns the texts known to have (or not to have) a dictionary entry."""
+        with self.lock:
+            rows = self._connect().execute('SELECT text FROM dictionary_entries WHERE has_entry = ?', (int(has_entry),)).fetchall()
+        return [row[0] for row in rows]
+
+    def set_pinyin(self, text, pinyin_text):
+        self._execute(
+            'INSERT OR REPLACE INTO pinyin (text, pinyin, updated_at) VALUES (?, ?, ?)',
+            (text, pinyin_text, time.time()))
+
+    def iter_pinyin(self):
+        """Returns all pinyin overrides as (text, pinyin) pairs."""
+        with self.lock:
+            return self._connect().execute('SELECT text, pinyin FROM pinyin').fetchall()
+
+    def stats(self):
+        stats = {table: self._fetch_one(f'SELECT COUNT(*) FROM {table}', ()) for table in TABLES}
+        stats['negative_dictionary_entries'] = self._fetch_one('SELECT COUNT(*) FROM dictionary_entries WHERE has_entry = 0', ())
+        return stats
+
+    def prune(self, max_age_days):
+        """Removes all entries that have not been updated within max_age_days, returns the number removed."""
+        cutoff = time.time() - max_age_days * 24 * 60 * 60
+        removed = sum(self._execute(f'DELETE FROM {table} WHERE updated_at < ?', (cutoff,)).rowcount for table in TABLES)
+        self._execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self._execute('VACUUM')
+        return removed
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None and self.pid == os.getpid():
+                self.connection.close()
+            self.connection = None
@@ -0,0 +1,44 @@
+import csv
+import os
+
+class CsvCache:
+    """The hand-corrected pinyin and translations of cache.csv, read on the first lookup."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._pinyin = None
+        self._translations = None
+
+    def _load(self):
+        self._pinyin = {}
+        self._translations = {}
+
+        if not os.path.exists(self.file_path):
+            return
+
+        with open(self.file_path, mode='r', encoding='utf-8-sig') as cache_file:
+            reader = csv.reader(cache_file, delimiter=';')
+            for row in reader:
+                if row:
+                    text, pinyin_text, translation = row[0], row[1], row[2]
+
+                    if len(pinyin_text or '') == 0:
+                        continue
+
+                    if len(pinyin_text or '') > 0:
+                        self._pinyin[text] = pinyin_text
+
+                    if len(translation or '') > 0:
+                        self._translations[text] = translation
+
+    @property
+    def pinyin(self):
+        if self._pinyin is None:
+            self._load()
+        return self._pinyin
+
+    @property
+    def translations(self):
+        if self._translations is None:
+            self._load()
+        return self._translations
@@ -0,0 +1,48 @@
+import csv
+import io
+import time
+from instrumentation import profiler
+
+class BufferedCsvWriter:
+    """Writes CSV rows to a file in chunks instead of flushing after every row.
+
+    Rows are added in groups (e.g. a phrase and its sub phrases) and collected in memory until
+    FLUSH_BYTES are buffered or FLUSH_INTERVAL seconds have passed since the last flush. Groups
+    are only ever written as a whole, so an interrupted run leaves a file ending with a complete group.
+    """
+    FLUSH_BYTES = 64 * 1024
+    FLUSH_INTERVAL = 2.0
+
+    def __init__(self, file, echo=False, delimiter=';'):
+        self.file = file
+        self.echo = echo
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, delimiter=delimiter)
+        self.flushed_at = time.monotonic()
+
+    def write_group(self, rows):
+        with profiler.time('csv.write_group'):
+            for row in rows:
+                if self.echo:
+                    print('\t\t\t'.join(row))
+                self.writer.writerow(row)
+
+        if self.buffer.tell() >= BufferedCsvWriter.FLUSH_BYTES \
+                or time.monotonic() - self.flushed_at >= BufferedCsvWriter.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        data = self.buffer.getvalue()
+        if data:
+            with profiler.time('csv.flush'):
+                self.file.write(data)
+                self.file.flush()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        self.flushed_at = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
@@ -0,0 +1,73 @@
+import os
+
+# Marker key for nodes that end a word (never a valid character)
+WORD_END = ''
+
+class DictionaryIndex:
+    """In-memory trie of known Chinese words used for offline segmentation."""
+
+    def __init__(self, words=None):
+        self.root = {}
+        self.size = 0
+
+        for word in words or []:
+            self.add(word)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, word):
+        node = self._find_node(word)
+        return node is not None and WORD_END in node
+
+    def add(self, word):
+        if not word:
+            return
+
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+
+        if WORD_END not in node:
+            node[WORD_END] = None
+            self.size += 1
+
+    def step(self, node, char):
+        """Returns the trie node reached from node by char, or None if no word continues that way."""
+        return node.get(char)
+
+    def _find_node(self, text):
+        node = self.root
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    @staticmethod
+    def parse_line(line):
+        """Returns the words of a CC-CEDICT line or a plain word list line (one word per line)."""
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return []
+
+        # CC-CEDICT: "Traditional Simplified [pin1 yin1] /definition/"
+        parts = line.split(' ', 2)
+        if len(parts) == 3 and parts[2].startswith('['):
+            return [parts[0], parts[1]]
+
+        # Word list (e.g. a dump of Wiktionary titles), optionally with extra tab separated columns
+        return [line.split('\t')[0].strip().replace('_', ' ')]
+
+    @staticmethod
+    def from_file(file_path):
+        if not os.path.isfile(file_path):
+            raise Exception(f'Dictionary file not found: {file_path}')
+
+        index = DictionaryIndex()
+        with open(file_path, mode='r', encoding='utf-8-sig') as file:
+            for line in file:
+                for word in DictionaryIndex.parse_line(line):
+                    index.add(word)
+
+        return index
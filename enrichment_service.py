@@ -0,0 +1,195 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import extract_chinese_from_pdfs
+import generate_flashcards_from_csvs
+from extract_chinese_from_pdfs import ChinesePhrase, get_option_value
+from generate_flashcards_from_csvs import Deck
+from instrumentation import profiler
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+def phrase_to_dict(chinese_phrase):
+    return {
+        'text': chinese_phrase.text,
+        'pinyin': chinese_phrase.pinyin,
+        'translation': chinese_phrase.translation,
+        'sub_phrases': [
+            {'text': sub_phrase.text, 'pinyin': sub_phrase.pinyin, 'translation': sub_phrase.translation}
+            for sub_phrase in chinese_phrase.sub_phrases],
+    }
+
+@contextmanager
+def phrase_options(body):
+    """Applies the skip options of a request for the duration of a job."""
+    skip_translation, skip_segmentation = ChinesePhrase.SKIP_TRANSLATION, ChinesePhrase.SKIP_SEGMENTATION
+    ChinesePhrase.SKIP_TRANSLATION = bool(body.get('skip_translation', skip_translation))
+    ChinesePhrase.SKIP_SEGMENTATION = bool(body.get('skip_segmentation', skip_segmentation))
+    try:
+        yield
+    finally:
+        ChinesePhrase.SKIP_TRANSLATION, ChinesePhrase.SKIP_SEGMENTATION = skip_translation, skip_segmentation
+
+def get_path(body, key='path'):
+    path = body.get(key)
+    if not isinstance(path, str) or not path:
+        raise ValueError(f"Please provide a valid {key.replace('_', ' ')}")
+    return path
+
+class EnrichmentService:
+    """Runs enrichment and flashcard jobs for thin clients, keeping everything warm in between.
+
+    All jobs run one at a time on a single event loop, so the phrase store, the pinyin table, the
+    caches and the translator clients (with their rate limits) are shared by every job, and a
+    job never sees the options of another.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.lock = asyncio.Lock()
+        self.started_at = time.time()
+        self.completed_jobs = 0
+        threading.Thread(target=self.loop.run_forever, name='enrichment-loop', daemon=True).start()
+
+    def run_job(self, job, body):
+        """Runs job(body) on the event loop, blocking the calling (request) thread until it is done."""
+        return asyncio.run_coroutine_threadsafe(self._run_job(job, body), self.loop).result()
+
+    async def _run_job(self, job, body):
+        async with self.lock:
+            result = await job(body)
+            self.completed_jobs += 1
+            return result
+
+    def warm_up(self):
+        # Reads cache.csv and builds the pinyin table now instead of during the first job
+        extract_chinese_from_pdfs.get_pinyin_engine().get('中文')
+
+    def health(self):
+        return {
+            'status': 'ok',
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'completed_jobs': self.completed_jobs,
+            'phrase_store': ChinesePhrase.STORE.stats(),
+        }
+
+    async def enrich(self, body):
+        phrases = body.get('phrases')
+        if not isinstance(phrases, list) or not all(isinstance(phrase, str) for phrase in phrases):
+            raise ValueError('Please provide the phrases as a list of strings')
+
+        with phrase_options(body):
+            instances = await asyncio.gather(*(ChinesePhrase.create_with_sub_phrases_async(phrase) for phrase in phrases))
+        return {'phrases': [phrase_to_dict(instance) for instance in instances]}
+
+    async def extract(self, body):
+        path = get_path(body)
+        output_directory = body.get('output_directory') or os.path.dirname(path)
+        pdf_paths = extract_chinese_from_pdfs.find_pdf_paths(path)
+
+        with phrase_options(body):
+            await extract_chinese_from_pdfs.main_async(path, output_directory, 1, bool(body.get('incremental')), bool(body.get('resume')), bool(body.get('corpus')))
+        return {'csv_file_paths': [extract_chinese_from_pdfs.get_csv_file_path(pdf_path, output_directory) for pdf_path in pdf_paths]}
+
+    async def flashcards(self, body):
+        path = get_path(body)
+        csv_paths = generate_flashcards_from_csvs.find_csv_paths(path)
+
+        definitions = body.get('decks')
+        if not isinstance(definitions, list) or not definitions:
+            raise ValueError('Please provide at least one deck')
+        decks = [Deck(definition.get('name', 'default'), get_path(definition, 'output_directory'), definition['template'], bool(definition.get('skip_segmented')))
+                 for definition in definitions]
+
+        # Rendering blocks, so it runs on a worker thread instead of stalling the event loop
+        await asyncio.to_thread(generate_flashcards_from_csvs.main, path, decks, 1, bool(body.get('incremental')))
+        return {'txt_file_paths': {
+            csv_path: [generate_flashcards_from_csvs.get_txt_file_path(csv_path, deck.output_directory) for deck in decks]
+            for csv_path in csv_paths}}
+
+class EnrichmentRequestHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, self.server.service.health())
+        else:
+            self._send_json(404, {'error': f'Unknown endpoint {self.path}'})
+
+    def do_POST(self):
+        service = self.server.service
+        jobs = {'/enrich': service.enrich, '/extract': service.extract, '/flashcards': service.flashcards}
+        job = jobs.get(self.path)
+        if job is None:
+            self._send_json(404, {'error': f'Unknown endpoint {self.path}'})
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(body, dict):
+                raise ValueError('The request body must be a JSON object')
+        except ValueError as e:
+            self._send_json(400, {'error': f'Invalid request body: {e}'})
+            return
+
+        try:
+            self._send_json(200, service.run_job(job, body))
+        except (KeyError, TypeError, ValueError) as e:
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+
+def create_server(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    server = ThreadingHTTPServer((host, port), EnrichmentRequestHandler)
+    server.daemon_threads = True
+    server.service = EnrichmentService()
+    return server
+
+if __name__ == "__main__":
+    host = DEFAULT_HOST
+    if '--host' in sys.argv:
+        host = get_option_value('--host', 'Please provide a valid host')
+
+    port = DEFAULT_PORT
+    if '--port' in sys.argv:
+        port = get_option_value('--port', 'Please provide a valid port')
+        if not port.isdigit():
+            print('Please provide a valid port')
+            sys.exit(1)
+        port = int(port)
+
+    if '--no-cache' not in sys.argv:
+        cache_path = extract_chinese_from_pdfs.default_cache_store_path
+        if '--cache' in sys.argv:
+            cache_path = get_option_value('--cache', 'Please provide a valid cache file path')
+        extract_chinese_from_pdfs.open_cache_store(cache_path)
+
+    extract_chinese_from_pdfs.apply_enrichment_options()
+
+    extract_chinese_from_pdfs.echo_csv_lines = False
+    profiler.enabled = '--profile' in sys.argv
+
+    server = create_server(host, port)
+    server.service.warm_up()
+    print(f"Enrichment service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if profiler.enabled:
+            profiler.print_report()
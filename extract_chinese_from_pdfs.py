@@ -1,104 +1,261 @@
 import asyncio
-from pypdf import PdfReader
 import re
-import pinyin
-import requests
-from bs4 import BeautifulSoup
-from googletrans import Translator
 import csv
+import itertools
 import sys
 import os
-
-# Ininitializing cache 
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from bloom_filter import EntryFilter
+from build_manifest import BuildManifest, hash_file
+from cache_store import CacheStore
+from csv_cache import CsvCache
+from csv_output import BufferedCsvWriter
+from dictionary_index import DictionaryIndex
+from instrumentation import profiler
+from phrase_pipeline import PhrasePipeline
+from phrase_store import PhraseStore
+from pinyin_engine import PinyinEngine
+from translation_scheduler import TranslationScheduler
+from wiktionary_client import WiktionaryClient
+
+# Ininitializing cache (cache.csv is read on the first lookup)
 cache_file_path = 'cache.csv'
+csv_cache = CsvCache(cache_file_path)
+
+# Persistent cache (results are written back as they are produced, cache.csv takes priority)
+default_cache_store_path = 'cache.sqlite3'
+cache_store = None
+
+# Earlier dictionary lookups, answered without querying the cache store (see EntryFilter)
+entry_filter = None
+
+def get_entry_filter_path(cache_store_path):
+    return os.path.splitext(cache_store_path)[0] + '.bloom'
+
+def open_cache_store(file_path=default_cache_store_path):
+    global cache_store, entry_filter, pinyin_engine
+    cache_store = CacheStore(file_path)
+    entry_filter = EntryFilter(get_entry_filter_path(file_path), cache_store)
+    # Rebuilt with the pinyin overrides of the store on the next lookup
+    pinyin_engine = None
+    return cache_store
+
+# Pinyin corrections from cache.csv and the cache store override the generated pinyin
+pinyin_engine = None
+
+def get_pinyin_engine():
+    global pinyin_engine
+    if pinyin_engine is None:
+        pinyin_engine = PinyinEngine()
+        # Added last, so cache.csv wins over a reading of the same text in the store
+        if cache_store is not None:
+            pinyin_engine.add_overrides(cache_store.iter_pinyin())
+        pinyin_engine.add_overrides(csv_cache.pinyin.items())
+    return pinyin_engine
+
+# Offline dictionary (segmentation falls back to Wiktionary when not loaded)
+dictionary = None
+dictionary_path = None
+
+def load_dictionary(file_path):
+    global dictionary, dictionary_path
+    dictionary = DictionaryIndex.from_file(file_path)
+    dictionary_path = file_path
+    return dictionary
+
+# Print every CSV line while writing (disabled with --quiet and in worker processes)
+echo_csv_lines = True
 
-pinyin_cache = dict()
-translation_cache = dict()
+# Simple functions 
+def iter_pdf_pages_text(pdf_path):
+    # The reader is opened eagerly (so invalid files fail early), pages are extracted lazily
+    from pypdf import PdfReader
 
-if os.path.exists(cache_file_path):
-    with open(cache_file_path, mode='r', encoding='utf-8-sig') as cache_file:
-        reader = csv.reader(cache_file, delimiter=';')
-        for row in reader:
-            if row:
-                text, pinyin_text, translation = row[0], row[1], row[2]
-                
-                if len(pinyin_text or '') == 0:
-                    continue
+    with profiler.time('pdf.open'):
+        pdf_reader = PdfReader(pdf_path)
+    return (extract_page_text(page) for page in pdf_reader.pages)
 
-                if len(pinyin_text or '') > 0:
-                    pinyin_cache[text] = pinyin_text
+def extract_page_text(page):
+    with profiler.time('pdf.page'):
+        return page.extract_text()
 
-                if len(translation or '') > 0:
-                    translation_cache[text] = translation
+# CJK Unified Ideographs (with extensions A to I) and the compatibility ideographs
+chinese_characters_pattern = re.compile(
+    r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+    r'\U00020000-\U0002a6df\U0002a700-\U0002ee5f\U00030000-\U000323af\U0002f800-\U0002fa1f]+')
 
-# Simple functions 
-def extract_text_from_pdf(pdf_path):
-    pdf_reader = PdfReader(pdf_path)
-    return ' '.join(page.extract_text() for page in pdf_reader.pages)
+PhraseOccurrence = namedtuple('PhraseOccurrence', ['text', 'page', 'offset'])
 
-def filter_chinese_characters(text):
-    chinese_signs = re.findall(r'[\u4e00-\u9fff]+', text)
-    return ' '.join(chinese_signs)
+def iter_phrase_occurrences(pages_text):
+    """Yields every Chinese phrase of the pages with its page number (from 1) and character offset in the page."""
+    for page, text in enumerate(pages_text, start=1):
+        for match in chinese_characters_pattern.finditer(text):
+            yield PhraseOccurrence(match.group(), page, match.start())
 
 def generate_pinyin(text):
-    if text in pinyin_cache:
-        return pinyin_cache[text]
-
-    return pinyin.get(text, delimiter=' ')
+    with profiler.time('pinyin'):
+        return get_pinyin_engine().get(text)
+
+wiktionary_client = WiktionaryClient()
+
+def set_dictionary_entry(chinese_phrase, has_entry):
+    cache_store.set_dictionary_entry(chinese_phrase, has_entry)
+    entry_filter.add(chinese_phrase, has_entry)
+
+def has_wiktionary_entries(chinese_phrases):
+    has_entry = {}
+    if entry_filter is not None:
+        for chinese_phrase in chinese_phrases:
+            known_entry = entry_filter.get(chinese_phrase)
+            if known_entry is not None:
+                has_entry[chinese_phrase] = known_entry
+
+    if cache_store is not None:
+        # The store may know lookups made by other processes since the filter was loaded
+        unknown_phrases = [chinese_phrase for chinese_phrase in chinese_phrases if chinese_phrase not in has_entry]
+        store_hits = 0
+        for chinese_phrase in unknown_phrases:
+            cached_entry = cache_store.get_dictionary_entry(chinese_phrase)
+            if cached_entry is not None:
+                has_entry[chinese_phrase] = cached_entry
+                entry_filter.add(chinese_phrase, cached_entry)
+                store_hits += 1
+        profiler.count('cache.store_dictionary.hit', store_hits)
+        profiler.count('cache.store_dictionary.miss', len(unknown_phrases) - store_hits)
+
+    missing_phrases = [chinese_phrase for chinese_phrase in chinese_phrases if chinese_phrase not in has_entry]
+    if not missing_phrases:
+        return has_entry
+
+    # A failed lookup fails the phrase (like a failed translation), as answering "no entry" would
+    # silently drop its sub phrases from the CSV, the phrase store and the manifest
+    with profiler.time('segmentation.wiktionary_lookup'):
+        fetched_entries = wiktionary_client.has_entries(missing_phrases)
+
+    if cache_store is not None:
+        for chinese_phrase, fetched_entry in fetched_entries.items():
+            set_dictionary_entry(chinese_phrase, fetched_entry)
+
+    has_entry.update(fetched_entries)
+    return has_entry
 
 def has_wiktionary_entry(chinese_phrase):
-    url = f'https://en.wiktionary.org/wiki/{chinese_phrase}'
-    response = requests.get(url)
-    
-    if response.status_code == 200:
-        soup = BeautifulSoup(response.content, 'html.parser')
-        chinese_section = soup.find('h2', id='Chinese')
-        return chinese_section is not None
-    else:
-        return False
+    return has_wiktionary_entries([chinese_phrase])[chinese_phrase]
     
-def extract_combinations(text):
-    combinations = set()
+def iter_combinations(text, prefix_index=None):
+    """Lazily yields the distinct substrings of text (except text itself) ordered by length, then position.
+
+    With a prefix index (a DictionaryIndex), start positions are dropped as soon as the substring
+    from them is not the beginning of any known word, so no impossible candidates are generated.
+    """
     length = len(text)
-    
-    for i in range(length):
-        for j in range(i + 1, length + 1):
-            combinations.add(text[i:j])
+    starts = [(start, prefix_index.root if prefix_index is not None else None) for start in range(length)]
+
+    for size in range(1, length):
+        seen = set()
+        next_starts = []
+        for start, node in starts:
+            end = start + size
+            if end > length:
+                break
+
+            if prefix_index is not None:
+                node = prefix_index.step(node, text[end - 1])
+                if node is None:
+                    continue
 
-    combinations.remove(text)
-    
-    sorted_combinations = sorted(combinations, key=lambda x: (len(x), text.index(x)))
+            next_starts.append((start, node))
+            candidate = text[start:end]
+            if candidate not in seen:
+                seen.add(candidate)
+                yield candidate
 
-    return list(sorted_combinations)
+        starts = next_starts
+
+def extract_combinations(text):
+    return list(iter_combinations(text))
+
+def extract_dictionary_sub_phrases(chinese_phrase):
+    return [sub_phrase for sub_phrase in iter_combinations(chinese_phrase, dictionary) if sub_phrase in dictionary]
 
 def extract_chinese_sub_phrases(chinese_phrase):
-    potential_sub_phrases = extract_combinations(chinese_phrase)
+    if dictionary is not None:
+        with profiler.time('segmentation.dictionary_lookup'):
+            return extract_dictionary_sub_phrases(chinese_phrase)
+
+    potential_sub_phrases = list(iter_combinations(chinese_phrase))
+    has_entry = has_wiktionary_entries(potential_sub_phrases)
 
-    valid_sub_phrases = []
-    for sub_phrase in potential_sub_phrases:
-        if has_wiktionary_entry(sub_phrase):
-            valid_sub_phrases.append(sub_phrase)
+    return [sub_phrase for sub_phrase in potential_sub_phrases if has_entry[sub_phrase]]
 
-    return valid_sub_phrases
+def create_translator():
+    # googletrans (and its HTTP stack) is only imported once something is translated
+    from googletrans import Translator
+    # Without raise_exception a throttled request "translates" the text to itself
+    return Translator(raise_exception=True)
+
+translation_scheduler = TranslationScheduler(create_translator)
 
 async def translateAsync(text, target_language):
-    if text in translation_cache:
-        return translation_cache[text]
+    if text in csv_cache.translations:
+        profiler.count('cache.translation_csv.hit')
+        return csv_cache.translations[text]
+    profiler.count('cache.translation_csv.miss')
+
+    if cache_store is not None:
+        cached_translation = cache_store.get_translation(text, target_language)
+        if cached_translation is not None:
+            profiler.count('cache.store_translation.hit')
+            return cached_translation
+        profiler.count('cache.store_translation.miss')
+
+    with profiler.time('translation'):
+        translation = await translation_scheduler.translate(text, target_language)
+    # Not added to csv_cache, which only holds the corrections of cache.csv. Repeated phrases
+    # are answered by the (bounded) phrase store and the cache store
+    if cache_store is not None:
+        cache_store.set_translation(text, target_language, translation)
+    return translation
+
+CSV_HEADER = ['Text', 'Pinyin', 'Translation', 'Sub Phrase Of', 'Page', 'Offset']
+
+def get_phrase_csv_rows(chinese_phrase, occurrence):
+    page = str(occurrence.page)
+    rows = [[chinese_phrase.text, chinese_phrase.pinyin, chinese_phrase.translation, '', page, str(occurrence.offset)]]
+    for sub_phrase in chinese_phrase.sub_phrases:
+        offset = occurrence.offset + chinese_phrase.text.find(sub_phrase.text)
+        rows.append([sub_phrase.text, sub_phrase.pinyin, sub_phrase.translation, chinese_phrase.text, page, str(offset)])
+    return rows
+
+def read_completed_phrases(csv_file_path):
+    """Returns the phrases (with their sub phrases) of a partially written CSV.
+
+    The last phrase is left out, as the run may have been interrupted while writing it.
+    """
+    phrases = []
+    with open(csv_file_path, mode='r', newline='\n', encoding='utf-8-sig') as file:
+        reader = csv.reader(file, delimiter=';')
+        next(reader, None)
+        for row in reader:
+            if len(row) < 4:
+                continue
 
-    translator = Translator()
-    translation = await translator.translate(text, dest=target_language)
-    return translation.text
+            text, pinyin_text, translation, parent_text = row[:4]
+            if not parent_text:
+                phrases.append(ChinesePhrase(text, pinyin_text, translation))
+            elif phrases and phrases[-1].text == parent_text:
+                phrases[-1].sub_phrases.append(ChinesePhrase(text, pinyin_text, translation))
 
-def write_csv_line(file, writer, elements):
-    print('\t\t\t'.join(elements))
-    writer.writerow(elements)
-    file.flush()
+    return phrases[:-1]
 
 class ChinesePhrase:
-    CACHE = {}
+    # Enriched phrases, shared by all files processed by this process
+    STORE = PhraseStore(max_entries=100000)
     SUB_PHRASE_LIMIT = 6
     SKIP_SEGMENTATION = False
     SKIP_TRANSLATION = False
+    TARGET_LANGUAGE = 'da'
     
     def __init__(self, text, pinyin, translation=None, sub_phrases=None):
         self.text = text
@@ -110,82 +267,554 @@ class ChinesePhrase:
         return f'{self.text} ({self.pinyin})'
 
     @staticmethod
-    async def create_async(text):
-        if text in ChinesePhrase.CACHE:
-            return ChinesePhrase.CACHE[text]
+    def is_segmented(phrase):
+        return not ChinesePhrase.SKIP_SEGMENTATION \
+            and (ChinesePhrase.SUB_PHRASE_LIMIT is None or len(phrase) <= ChinesePhrase.SUB_PHRASE_LIMIT)
+
+    @staticmethod
+    def from_store(text, with_sub_phrases=False):
+        """Returns the stored phrase or None. With with_sub_phrases, a phrase that was never segmented (e.g. only stored as a sub phrase) counts as missing."""
+        stored = ChinesePhrase.STORE.get(text)
+        if stored is None:
+            return None
+
+        pinyin_text, translation, sub_phrases = stored
+        if sub_phrases is None:
+            if with_sub_phrases:
+                return None
+            sub_phrases = []
+        return ChinesePhrase(text, pinyin_text, translation, [ChinesePhrase(*sub_phrase) for sub_phrase in sub_phrases])
 
-        pinyin_text = generate_pinyin(text)
-        translation = await translateAsync(text, 'da') if not ChinesePhrase.SKIP_TRANSLATION else ''
+    @staticmethod
+    async def create_async(text, pinyin_text=None):
+        instance = ChinesePhrase.from_store(text)
+        if instance is not None:
+            profiler.count('cache.phrase.hit')
+            return instance
+        profiler.count('cache.phrase.miss')
+
+        if pinyin_text is None:
+            pinyin_text = generate_pinyin(text)
+        translation = await translateAsync(text, ChinesePhrase.TARGET_LANGUAGE) if not ChinesePhrase.SKIP_TRANSLATION else ''
         
         instance =  ChinesePhrase(text, pinyin_text, translation)
-        ChinesePhrase.CACHE[text] = instance
+        ChinesePhrase.STORE.add(text, pinyin_text, translation)
         return instance
+
+    @staticmethod
+    async def create_sub_phrase_async(text, pinyin_text):
+        """Returns a sub phrase read as pinyin_text (its reading in the phrase it was taken from).
+
+        Only the translation is taken from (or added to) the store, which keeps the phrase's own reading.
+        """
+        stored = ChinesePhrase.STORE.get(text)
+        if stored is not None:
+            profiler.count('cache.phrase.hit')
+            return ChinesePhrase(text, pinyin_text, stored[1])
+        profiler.count('cache.phrase.miss')
+
+        translation = await translateAsync(text, ChinesePhrase.TARGET_LANGUAGE) if not ChinesePhrase.SKIP_TRANSLATION else ''
+        ChinesePhrase.STORE.add(text, generate_pinyin(text), translation)
+        return ChinesePhrase(text, pinyin_text, translation)
     
     @staticmethod
     async def create_with_sub_phrases_async(phrase):
-        if phrase in ChinesePhrase.CACHE:
-            return ChinesePhrase.CACHE[phrase]
-
-        if len(phrase) > ChinesePhrase.SUB_PHRASE_LIMIT: 
-            return await ChinesePhrase.create_async(phrase)
-        
-        if ChinesePhrase.SKIP_SEGMENTATION:
+        if not ChinesePhrase.is_segmented(phrase):
             return await ChinesePhrase.create_async(phrase)
 
-        instance = await ChinesePhrase.create_async(phrase)
+        # Whichever phrase comes first, a phrase stored as a sub phrase of another gets its own sub phrases
+        instance = ChinesePhrase.from_store(phrase, with_sub_phrases=True)
+        if instance is not None:
+            profiler.count('cache.phrase.hit')
+            return instance
+
+        with profiler.time('enrichment.phrase_with_sub_phrases'):
+            # Online lookups block, so they run on a worker thread
+            with profiler.time('segmentation'):
+                sub_phrases = await asyncio.to_thread(extract_chinese_sub_phrases, phrase)
+
+            # The sub phrases are read the same way as in the phrase
+            with profiler.time('pinyin'):
+                pinyin_text, sub_phrases_pinyin = get_pinyin_engine().get_with_parts(phrase, sub_phrases)
+
+            instance, *sub_instances = await asyncio.gather(
+                ChinesePhrase.create_async(phrase, pinyin_text),
+                *(ChinesePhrase.create_sub_phrase_async(sub_phrase, sub_phrase_pinyin) 
+                  for sub_phrase, sub_phrase_pinyin in zip(sub_phrases, sub_phrases_pinyin)))
         
-        instance.sub_phrases = []
-        for sub_phrase in extract_chinese_sub_phrases(phrase):
-            sub_instance = await ChinesePhrase.create_async(sub_phrase)
-            instance.sub_phrases.append(sub_instance)
-
+        instance.sub_phrases = sub_instances
+        ChinesePhrase.STORE.set_sub_phrases(phrase, zip(sub_phrases, sub_phrases_pinyin))
         return instance
 
-async def process_file_async(pdf_path, output_directory):
-    print("\nProcessing file: ", pdf_path)
+    @staticmethod
+    def add_to_store(phrases):
+        """Stores phrases read back from a CSV, as if they had just been created in this order."""
+        store = ChinesePhrase.STORE
+        for phrase in phrases:
+            for sub_phrase in phrase.sub_phrases:
+                if sub_phrase.text not in store:
+                    # The pinyin of a sub phrase is its reading in this phrase, not necessarily its own
+                    store.add(sub_phrase.text, generate_pinyin(sub_phrase.text), sub_phrase.translation)
+
+            if phrase.text not in store:
+                store.add(phrase.text, phrase.pinyin, phrase.translation)
+            if phrase.sub_phrases:
+                store.set_sub_phrases(phrase.text, [(sub_phrase.text, sub_phrase.pinyin) for sub_phrase in phrase.sub_phrases])
+
+def get_csv_file_path(pdf_path, output_directory):
     pdf_file_name = os.path.basename(pdf_path)
     csv_file_name = pdf_file_name.replace('.pdf', '.csv')
-    csv_file_path = os.path.join(output_directory, csv_file_name)
+    return os.path.join(output_directory, csv_file_name)
+
+async def process_file_async(pdf_path, output_directory, on_progress=None, resume=False):
+    """Converts a PDF to a CSV file, calling on_progress with the number of phrases written so far after each phrase.
+
+    With resume, the phrases of an existing (partial) CSV are kept and only the phrases after them are processed.
+    """
+    print("\nProcessing file: ", pdf_path)
+    csv_file_path = get_csv_file_path(pdf_path, output_directory)
 
-    pdf_text = extract_text_from_pdf(pdf_path)
-    chinese_text = filter_chinese_characters(pdf_text)
+    pages_text = iter_pdf_pages_text(pdf_path)
+    occurrences = iter_phrase_occurrences(pages_text)
 
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
+    # Worker processes may create the same directory at the same time
+    if output_directory:
+        os.makedirs(output_directory, exist_ok=True)
 
-    with open(csv_file_path, mode='w', newline='\n', encoding='utf-8-sig') as file:
-        writer = csv.writer(file, delimiter=';')
-        write_csv_line(file, writer, ['Text', 'Pinyin', 'Translation', 'Sub Phrase Of'])
-                       
-        for part in chinese_text.split():
-            chinese_phrase = await ChinesePhrase.create_with_sub_phrases_async(part)
-            write_csv_line(file, writer, [chinese_phrase.text, chinese_phrase.pinyin, chinese_phrase.translation, ''])
-            
-            for sub_phrase in chinese_phrase.sub_phrases:
-                write_csv_line(file, writer, [sub_phrase.text, sub_phrase.pinyin, sub_phrase.translation, chinese_phrase.text])
+    completed_phrases = []
+    if resume and os.path.exists(csv_file_path):
+        completed_phrases = read_completed_phrases(csv_file_path)
+
+        # The CSV must have been generated from the same PDF, phrase by phrase
+        completed_occurrences = list(itertools.islice(occurrences, len(completed_phrases)))
+        if [occurrence.text for occurrence in completed_occurrences] == [phrase.text for phrase in completed_phrases]:
+            print(f"Resuming after {len(completed_phrases)} phrases")
+            ChinesePhrase.add_to_store(completed_phrases)
+        else:
+            print("The CSV does not match the PDF, starting over")
+            occurrences = itertools.chain(completed_occurrences, occurrences)
+            completed_phrases = []
+
+    if completed_phrases:
+        # Drops whatever was written after the completed phrases, then appends to them
+        temporary_file_path = csv_file_path + '.tmp'
+        with open(temporary_file_path, mode='w', newline='\n', encoding='utf-8-sig') as file:
+            with BufferedCsvWriter(file) as output:
+                output.write_group([CSV_HEADER])
+                for phrase, occurrence in zip(completed_phrases, completed_occurrences):
+                    output.write_group(get_phrase_csv_rows(phrase, occurrence))
+        os.replace(temporary_file_path, csv_file_path)
+
+    with open(csv_file_path, mode='a' if completed_phrases else 'w', newline='\n', encoding='utf-8-sig') as file, \
+            BufferedCsvWriter(file, echo_csv_lines) as output:
+        if not completed_phrases:
+            output.write_group([CSV_HEADER])
+
+        # Pages are parsed, phrases enriched and rows written at the same time, in document order
+        phrase_count = len(completed_phrases)
+
+        def write_phrase(occurrence, chinese_phrase):
+            nonlocal phrase_count
+            output.write_group(get_phrase_csv_rows(chinese_phrase, occurrence))
+            phrase_count += 1
+            if on_progress is not None:
+                on_progress(phrase_count)
+
+        pipeline = PhrasePipeline(lambda occurrence: ChinesePhrase.create_with_sub_phrases_async(occurrence.text), write_phrase, output.flush)
+        await pipeline.run(occurrences)
 
     return csv_file_path
 
-async def main_async(path, output_directory): 
+def collect_phrase_occurrences(pdf_path):
+    return list(iter_phrase_occurrences(iter_pdf_pages_text(pdf_path)))
+
+async def has_wiktionary_entries_async(chinese_phrases):
+    """Like has_wiktionary_entries, looking up batches of the phrases concurrently (at most as many as file mode looks up at once)."""
+    batch_size = WiktionaryClient.BATCH_SIZE
+    concurrent_lookups = asyncio.Semaphore(PhrasePipeline.WORKERS)
+
+    async def look_up(batch):
+        async with concurrent_lookups:
+            return await asyncio.to_thread(has_wiktionary_entries, batch)
+
+    has_entry = {}
+    batches = [chinese_phrases[i:i + batch_size] for i in range(0, len(chinese_phrases), batch_size)]
+    for batch_entries in await asyncio.gather(*(look_up(batch) for batch in batches)):
+        has_entry.update(batch_entries)
+    return has_entry
+
+async def resolve_phrases_async(texts):
+    """Enriches the distinct phrases of texts in bulk, returns a dict of ChinesePhrase by text.
+
+    Unlike create_with_sub_phrases_async, which enriches one phrase at a time, the sub phrase
+    candidates of all phrases are looked up together, and every phrase and sub phrase is
+    translated once however many phrases it appears in.
+    """
+    resolved = {}
+    unresolved = []
+    for text in dict.fromkeys(texts):
+        instance = ChinesePhrase.from_store(text, with_sub_phrases=ChinesePhrase.is_segmented(text))
+        if instance is not None:
+            resolved[text] = instance
+        else:
+            unresolved.append(text)
+    profiler.count('cache.phrase.hit', len(resolved))
+    profiler.count('cache.phrase.miss', len(unresolved))
+
+    segmented = [text for text in unresolved if ChinesePhrase.is_segmented(text)]
+    sub_phrases = {}
+    with profiler.time('segmentation'):
+        if dictionary is not None:
+            with profiler.time('segmentation.dictionary_lookup'):
+                for text in segmented:
+                    sub_phrases[text] = extract_dictionary_sub_phrases(text)
+        elif segmented:
+            candidates = {text: extract_combinations(text) for text in segmented}
+            distinct_candidates = list(dict.fromkeys(itertools.chain.from_iterable(candidates.values())))
+            print(f"Looking up {len(distinct_candidates)} sub phrase candidates")
+            has_entry = await has_wiktionary_entries_async(distinct_candidates)
+            for text, text_candidates in candidates.items():
+                sub_phrases[text] = [candidate for candidate in text_candidates if has_entry[candidate]]
+
+    # The sub phrases are read the same way as in their phrase
+    with profiler.time('pinyin'):
+        readings = {text: get_pinyin_engine().get_with_parts(text, sub_phrases.get(text, [])) for text in unresolved}
+
+    translations = {}
+    if not ChinesePhrase.SKIP_TRANSLATION:
+        # Requested all at once, so the translation scheduler can fill its batches
+        texts_to_translate = list(dict.fromkeys(itertools.chain(unresolved, *sub_phrases.values())))
+        print(f"Translating {len(texts_to_translate)} phrases and sub phrases")
+        translated = await asyncio.gather(*(translateAsync(text, ChinesePhrase.TARGET_LANGUAGE) for text in texts_to_translate))
+        translations = dict(zip(texts_to_translate, translated))
+
+    phrases = []
+    for text in unresolved:
+        pinyin_text, sub_phrases_pinyin = readings[text]
+        phrase = ChinesePhrase(text, pinyin_text, translations.get(text, ''), [
+            ChinesePhrase(sub_phrase, sub_phrase_pinyin, translations.get(sub_phrase, ''))
+            for sub_phrase, sub_phrase_pinyin in zip(sub_phrases.get(text, []), sub_phrases_pinyin)])
+        resolved[text] = phrase
+        phrases.append(phrase)
+
+    ChinesePhrase.add_to_store(phrases)
+    return resolved
+
+def write_phrases_csv(csv_file_path, occurrences, phrases):
+    with open(csv_file_path, mode='w', newline='\n', encoding='utf-8-sig') as file, \
+            BufferedCsvWriter(file, echo_csv_lines) as output:
+        output.write_group([CSV_HEADER])
+        for occurrence in occurrences:
+            output.write_group(get_phrase_csv_rows(phrases[occurrence.text], occurrence))
+
+def collect_in_worker(pdf_path):
+    profiler.reset()
+    return collect_phrase_occurrences(pdf_path), profiler.snapshot()
+
+async def process_corpus_async(pdf_paths, output_directory, jobs=1, on_processed=None):
+    """Converts the PDFs in three phases: collects the phrases of all files, enriches every distinct phrase once, then writes the CSVs.
+
+    Lookups and translations therefore grow with the vocabulary of the corpus rather than its size.
+    Returns the CSV paths in the order of pdf_paths.
+    """
+    with profiler.time('corpus.collect'):
+        if jobs > 1 and len(pdf_paths) > 1:
+            worker_settings = dict(get_settings(), echo_csv_lines=False)
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(max_workers=jobs, initializer=apply_settings, initargs=(worker_settings,)) as pool:
+                collected = await asyncio.gather(*(loop.run_in_executor(pool, collect_in_worker, pdf_path) for pdf_path in pdf_paths))
+            occurrences_by_file = []
+            for occurrences, profile_snapshot in collected:
+                profiler.merge(profile_snapshot)
+                occurrences_by_file.append(occurrences)
+        else:
+            occurrences_by_file = []
+            for pdf_path in pdf_paths:
+                print("Collecting phrases: ", pdf_path)
+                occurrences_by_file.append(collect_phrase_occurrences(pdf_path))
+
+    texts = [occurrence.text for occurrences in occurrences_by_file for occurrence in occurrences]
+    distinct_texts = list(dict.fromkeys(texts))
+    print(f"Found {len(texts)} phrases ({len(distinct_texts)} distinct) in {len(pdf_paths)} files")
+
+    with profiler.time('corpus.resolve'):
+        phrases = await resolve_phrases_async(distinct_texts)
+
+    # Worker processes may create the same directory at the same time
+    if output_directory:
+        os.makedirs(output_directory, exist_ok=True)
+
+    csv_file_paths = []
+    with profiler.time('corpus.emit'):
+        for completed, (pdf_path, occurrences) in enumerate(zip(pdf_paths, occurrences_by_file), start=1):
+            csv_file_path = get_csv_file_path(pdf_path, output_directory)
+            write_phrases_csv(csv_file_path, occurrences, phrases)
+            print(f"[{completed}/{len(pdf_paths)}] Finished: {csv_file_path}")
+            if on_processed is not None:
+                on_processed(pdf_path, csv_file_path)
+            csv_file_paths.append(csv_file_path)
+
+    return csv_file_paths
+
+def warm_cache(path):
+    """Imports translations, confirmed sub phrases and pinyin corrections from generated CSV files into the cache store."""
     if os.path.isdir(path):
-        pdf_files = [f for f in os.listdir(path) if f.endswith('.pdf')]
-        if not pdf_files:
-            print('No PDF files found in the directory')
-            sys.exit(1)
-        for pdf_file in pdf_files:
-            await process_file_async(os.path.join(path, pdf_file), output_directory)
+        csv_paths = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.csv')]
     else:
-        if not os.path.isfile(path):
-            print('The provided path is not a valid file or directory')
+        csv_paths = [path]
+
+    imported = 0
+    for csv_path in csv_paths:
+        with open(csv_path, mode='r', newline='\n', encoding='utf-8-sig') as file:
+            reader = csv.reader(file, delimiter=';')
+            next(reader, None)
+            rows = [row for row in reader if len(row) >= 3 and row[0]]
+
+        generated_pinyin = get_pinyin_engine().get_many([row[0] for row in rows])
+        for row, generated_pinyin_text in zip(rows, generated_pinyin):
+            text, pinyin_text, translation = row[0], row[1], row[2]
+            if translation and text not in csv_cache.translations:
+                cache_store.set_translation(text, ChinesePhrase.TARGET_LANGUAGE, translation)
+            is_sub_phrase = len(row) > 3 and row[3]
+            if is_sub_phrase:
+                set_dictionary_entry(text, True)
+            # A sub phrase is read as in its phrase, which is no correction of its own reading
+            if not is_sub_phrase and pinyin_text and text not in csv_cache.pinyin and pinyin_text != generated_pinyin_text:
+                cache_store.set_pinyin(text, pinyin_text)
+                get_pinyin_engine().add_override(text, pinyin_text)
+            imported += 1
+
+    return imported
+
+def print_cache_stats():
+    print(f"Cache store: {cache_store.file_path}")
+    for name, count in cache_store.stats().items():
+        print(f"  {name}: {count}")
+
+def print_entry_filter_report():
+    report = entry_filter.report()
+    print(f"Bloom filter: {report['file_path']}")
+    print(f"  entries (exact): {report['entries']}")
+    print(f"  non entries: {report['non_entries']} (capacity {report['capacity']})")
+    print(f"  size: {report['size_bytes'] / 1024:.1f} KB, {report['hash_count']} hashes")
+    print(f"  estimated false positive rate: {report['estimated_false_positive_rate']:.4%}")
+    print(f"  measured false positive rate: {report['measured_false_positive_rate']:.4%}")
+
+def get_option_value(option, error_message):
+    option_index = sys.argv.index(option) + 1
+    if option_index < len(sys.argv) and "--" not in sys.argv[option_index]:
+        return sys.argv[option_index]
+
+    print(error_message)
+    sys.exit(1)
+
+def apply_enrichment_options():
+    """Applies the dictionary, Wiktionary, phrase cache and worker options, shared with enrichment_service.py."""
+    if '--dictionary' in sys.argv:
+        index = load_dictionary(get_option_value('--dictionary', 'Please provide a valid dictionary file path'))
+        print(f"Using offline dictionary with {len(index)} words")
+
+        # Offline lookups are cheap enough to segment phrases of any length
+        ChinesePhrase.SUB_PHRASE_LIMIT = None
+
+    if '--wiktionary-api-url' in sys.argv:
+        wiktionary_client.api_url = get_option_value('--wiktionary-api-url', 'Please provide a valid Wiktionary API URL')
+
+    if '--phrase-cache-size' in sys.argv:
+        phrase_cache_size = get_option_value('--phrase-cache-size', 'Please provide a valid phrase cache size (0 for no limit)')
+        if not phrase_cache_size.isdigit():
+            print('Please provide a valid phrase cache size (0 for no limit)')
+            sys.exit(1)
+        ChinesePhrase.STORE.resize(int(phrase_cache_size) or None)
+
+    if '--workers' in sys.argv:
+        workers = get_option_value('--workers', 'Please provide a valid number of enrichment workers (positive integer)')
+        if not workers.isdigit() or int(workers) == 0:
+            print('Please provide a valid number of enrichment workers (positive integer)')
             sys.exit(1)
-        await process_file_async(path, output_directory)
+        PhrasePipeline.WORKERS = int(workers)
+
+    if '--queue-size' in sys.argv:
+        queue_size = get_option_value('--queue-size', 'Please provide a valid queue size (positive integer)')
+        if not queue_size.isdigit() or int(queue_size) == 0:
+            print('Please provide a valid queue size (positive integer)')
+            sys.exit(1)
+        PhrasePipeline.QUEUE_SIZE = int(queue_size)
+
+def get_settings():
+    return {
+        'skip_translation': ChinesePhrase.SKIP_TRANSLATION,
+        'skip_segmentation': ChinesePhrase.SKIP_SEGMENTATION,
+        'sub_phrase_limit': ChinesePhrase.SUB_PHRASE_LIMIT,
+        'phrase_store_max_entries': ChinesePhrase.STORE.max_entries,
+        'pipeline_workers': PhrasePipeline.WORKERS,
+        'pipeline_queue_size': PhrasePipeline.QUEUE_SIZE,
+        'concurrency': TranslationScheduler.CONCURRENCY,
+        'translation_batch_characters': TranslationScheduler.BATCH_CHARACTERS,
+        'dictionary_path': dictionary_path,
+        'wiktionary_api_url': wiktionary_client.api_url,
+        'cache_store_path': cache_store.file_path if cache_store is not None else None,
+        'echo_csv_lines': echo_csv_lines,
+        'profile': profiler.enabled,
+    }
+
+def apply_settings(settings):
+    global cache_store, entry_filter, pinyin_engine, dictionary, dictionary_path, echo_csv_lines
+    ChinesePhrase.SKIP_TRANSLATION = settings['skip_translation']
+    ChinesePhrase.SKIP_SEGMENTATION = settings['skip_segmentation']
+    ChinesePhrase.SUB_PHRASE_LIMIT = settings['sub_phrase_limit']
+    ChinesePhrase.STORE.resize(settings['phrase_store_max_entries'])
+    PhrasePipeline.WORKERS = settings['pipeline_workers']
+    PhrasePipeline.QUEUE_SIZE = settings['pipeline_queue_size']
+    TranslationScheduler.CONCURRENCY = settings['concurrency']
+    TranslationScheduler.BATCH_CHARACTERS = settings['translation_batch_characters']
+    echo_csv_lines = settings['echo_csv_lines']
+    profiler.enabled = settings['profile']
+    wiktionary_client.api_url = settings['wiktionary_api_url']
+
+    if settings['dictionary_path'] is None:
+        dictionary = dictionary_path = None
+    elif settings['dictionary_path'] != dictionary_path:
+        load_dictionary(settings['dictionary_path'])
+
+    if settings['cache_store_path'] is None:
+        cache_store = entry_filter = pinyin_engine = None
+    elif cache_store is None or cache_store.file_path != settings['cache_store_path']:
+        open_cache_store(settings['cache_store_path'])
+
+def get_output_settings():
+    """Returns the settings (and inputs besides the PDF) that affect the content of the generated CSVs."""
+    return {
+        'skip_translation': ChinesePhrase.SKIP_TRANSLATION,
+        'skip_segmentation': ChinesePhrase.SKIP_SEGMENTATION,
+        'sub_phrase_limit': ChinesePhrase.SUB_PHRASE_LIMIT,
+        'target_language': ChinesePhrase.TARGET_LANGUAGE,
+        'csv_header': CSV_HEADER,
+        'dictionary_hash': hash_file(dictionary_path) if dictionary_path is not None else None,
+        'cache_file_hash': hash_file(cache_file_path) if os.path.exists(cache_file_path) else None,
+    }
+
+def process_file_in_worker(pdf_path, output_directory, resume=False):
+    """Returns the CSV path and the profiling data collected for this file (merged by the parent)."""
+    profiler.reset()
+    csv_file_path = asyncio.run(process_file_async(pdf_path, output_directory, resume=resume))
+    return csv_file_path, profiler.snapshot()
+
+async def process_files_in_pool_async(pdf_paths, output_directory, jobs, on_processed=None, resume=False):
+    """Processes the files in worker processes, returns the CSV paths in the order of pdf_paths."""
+    worker_settings = dict(get_settings(), echo_csv_lines=False)
+    loop = asyncio.get_running_loop()
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=apply_settings, initargs=(worker_settings,)) as pool:
+        async def process_in_pool(pdf_path):
+            csv_file_path, profile_snapshot = await loop.run_in_executor(pool, process_file_in_worker, pdf_path, output_directory, resume)
+            profiler.merge(profile_snapshot)
+            return pdf_path, csv_file_path
+
+        futures = [asyncio.ensure_future(process_in_pool(pdf_path)) for pdf_path in pdf_paths]
+
+        for completed, future in enumerate(asyncio.as_completed(futures), start=1):
+            pdf_path, csv_file_path = await future
+            print(f"[{completed}/{len(futures)}] Finished: {csv_file_path}")
+            if on_processed is not None:
+                on_processed(pdf_path, csv_file_path)
+
+        return [future.result()[1] for future in futures]
+
+def find_pdf_paths(path):
+    """Returns the PDFs of a directory (sorted by name) or the PDF itself, raises ValueError if there are none."""
+    if os.path.isdir(path):
+        pdf_files = sorted(f for f in os.listdir(path) if f.endswith('.pdf'))
+        if not pdf_files:
+            raise ValueError('No PDF files found in the directory')
+        return [os.path.join(path, pdf_file) for pdf_file in pdf_files]
+
+    if not os.path.isfile(path):
+        raise ValueError('The provided path is not a valid file or directory')
+    return [path]
+
+async def main_async(path, output_directory, jobs=1, incremental=False, resume=False, corpus=False): 
+    try:
+        pdf_paths = find_pdf_paths(path)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    manifest = None
+    if incremental:
+        manifest = BuildManifest(output_directory)
+        output_settings = get_output_settings()
+
+        outdated_pdf_paths = []
+        for pdf_path in pdf_paths:
+            if manifest.is_up_to_date(pdf_path, get_csv_file_path(pdf_path, output_directory), output_settings):
+                print("Up to date: ", pdf_path)
+            else:
+                outdated_pdf_paths.append(pdf_path)
+        pdf_paths = outdated_pdf_paths
+
+    def record_processed(pdf_path, csv_file_path):
+        if manifest is not None:
+            manifest.record(pdf_path, csv_file_path, output_settings)
+            manifest.save()
+
+    if corpus:
+        if pdf_paths:
+            await process_corpus_async(pdf_paths, output_directory, jobs, record_processed)
+        return
+
+    if jobs > 1 and len(pdf_paths) > 1:
+        await process_files_in_pool_async(pdf_paths, output_directory, jobs, record_processed, resume)
+        return
+
+    for pdf_path in pdf_paths:
+        record_processed(pdf_path, await process_file_async(pdf_path, output_directory, resume=resume))
 
 if __name__ == "__main__":
     # Get pdf/directory path from arguments 
     file_path = None 
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 1 and not sys.argv[1].startswith('--'):
         file_path = sys.argv[1]
-    else: 
+
+    # Cache options
+    if '--no-cache' not in sys.argv:
+        cache_path = default_cache_store_path
+        if '--cache' in sys.argv:
+            cache_path = get_option_value('--cache', 'Please provide a valid cache file path')
+        open_cache_store(cache_path)
+
+    is_cache_command = False
+    if cache_store is not None:
+        if '--cache-warm' in sys.argv:
+            warm_path = get_option_value('--cache-warm', 'Please provide a valid CSV file or directory path')
+            print(f"Imported {warm_cache(warm_path)} rows into the cache")
+            is_cache_command = True
+
+        if '--cache-prune' in sys.argv:
+            max_age_days = get_option_value('--cache-prune', 'Please provide a valid age in days')
+            if not max_age_days.isdigit():
+                print('Please provide a valid age in days')
+                sys.exit(1)
+            print(f"Pruned {cache_store.prune(int(max_age_days))} cache entries")
+            # The filter still holds the pruned non entries
+            entry_filter.rebuild()
+            is_cache_command = True
+
+        if '--bloom-rebuild' in sys.argv:
+            print(f"Rebuilt the Bloom filter with {entry_filter.rebuild()} non entries")
+            is_cache_command = True
+
+        if '--bloom-report' in sys.argv:
+            print_entry_filter_report()
+            is_cache_command = True
+
+        if '--cache-inspect' in sys.argv:
+            print_cache_stats()
+            is_cache_command = True
+
+    if file_path is None:
+        if is_cache_command:
+            sys.exit(0)
         print('Please provide a path to a PDF file')
         sys.exit(1)
 
@@ -203,6 +832,59 @@ if __name__ == "__main__":
             print('Please provide a valid output directory path')
             sys.exit(1)
 
+    if '--service' in sys.argv:
+        # Thin client, the enrichment service (with its own cache, dictionary and limits) does the work.
+        # Imported here, so other runs never load the HTTP stack
+        from service_client import EnrichmentServiceClient, ServiceError
+
+        service_client = EnrichmentServiceClient(get_option_value('--service', 'Please provide a valid service URL'))
+        try:
+            csv_file_paths = service_client.extract(
+                file_path, output_directory,
+                skip_translation='--skip-translation' in sys.argv or '--skip-all' in sys.argv,
+                skip_segmentation='--skip-segmentation' in sys.argv or '--skip-all' in sys.argv,
+                incremental='--incremental' in sys.argv,
+                resume='--resume' in sys.argv,
+                corpus='--corpus' in sys.argv)
+        except ServiceError as e:
+            print(f"The enrichment service failed: {e}")
+            sys.exit(1)
+
+        for csv_file_path in csv_file_paths:
+            print("CSV file generated: ", csv_file_path)
+        sys.exit(0)
+
+    apply_enrichment_options()
+
+    if '--sub-phrase-limit' in sys.argv:
+        sub_phrase_limit = get_option_value('--sub-phrase-limit', 'Please provide a valid sub phrase limit (0 for no limit)')
+        if not sub_phrase_limit.isdigit():
+            print('Please provide a valid sub phrase limit (0 for no limit)')
+            sys.exit(1)
+        ChinesePhrase.SUB_PHRASE_LIMIT = int(sub_phrase_limit) or None
+
+    if '--concurrency' in sys.argv:
+        concurrency = get_option_value('--concurrency', 'Please provide a valid concurrency (positive integer)')
+        if not concurrency.isdigit() or int(concurrency) == 0:
+            print('Please provide a valid concurrency (positive integer)')
+            sys.exit(1)
+        TranslationScheduler.CONCURRENCY = int(concurrency)
+
+    if '--translation-batch' in sys.argv:
+        batch_characters = get_option_value('--translation-batch', 'Please provide a valid translation batch size (characters, 0 to disable batching)')
+        if not batch_characters.isdigit():
+            print('Please provide a valid translation batch size (characters, 0 to disable batching)')
+            sys.exit(1)
+        TranslationScheduler.BATCH_CHARACTERS = int(batch_characters)
+
+    jobs = 1
+    if '--jobs' in sys.argv:
+        jobs = get_option_value('--jobs', 'Please provide a valid number of jobs (positive integer)')
+        if not jobs.isdigit() or int(jobs) == 0:
+            print('Please provide a valid number of jobs (positive integer)')
+            sys.exit(1)
+        jobs = int(jobs)
+
     if '--skip-translation' in sys.argv or '--skip-all' in sys.argv:
         print("Skipping translation")
         ChinesePhrase.SKIP_TRANSLATION = True
@@ -211,5 +893,25 @@ if __name__ == "__main__":
         print("Skipping segmentation")
         ChinesePhrase.SKIP_SEGMENTATION = True
         
-    asyncio.run(main_async(file_path, output_directory))
+    profile_json_path = None
+    if '--profile-json' in sys.argv:
+        profile_json_path = get_option_value('--profile-json', 'Please provide a valid JSON file path')
+    profiler.enabled = '--profile' in sys.argv or profile_json_path is not None
+
+    if '--quiet' in sys.argv:
+        echo_csv_lines = False
+
+    incremental = '--incremental' in sys.argv
+    resume = '--resume' in sys.argv
+    corpus = '--corpus' in sys.argv
+    if corpus and resume:
+        print("--resume has no effect with --corpus, as the CSVs are only written once all phrases are enriched")
+    with profiler.time('total'):
+        asyncio.run(main_async(file_path, output_directory, jobs, incremental, resume, corpus))
+
+    if '--profile' in sys.argv:
+        profiler.print_report()
+    if profile_json_path is not None:
+        profiler.write_json(profile_json_path)
+        print(f"Profile written to {profile_json_path}")
     
\ No newline at end of file
@@ -1,16 +1,26 @@
 import sys
 import os
 import csv
+import hashlib
+import json
+import operator
+import string
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from build_manifest import BuildManifest
 
 class CsvLine: 
-    def __init__(self, text, pinyin, translation, is_sub_prase):
+    __slots__ = ('text', 'pinyin', 'translation', 'is_sub_prase', 'page')
+
+    def __init__(self, text, pinyin, translation, is_sub_prase, page=''):
         self.text = text
         self.pinyin = pinyin
         self.translation = translation
         self.is_sub_prase = is_sub_prase
+        self.page = page
 
     def __str__(self):
-        return f"Text: {self.text}, Pinyin: {self.pinyin}, Translation: {self.translation}, Sub Phrase Of: {self.sub_phrase_of}"
+        return f"Text: {self.text}, Pinyin: {self.pinyin}, Translation: {self.translation}, Is Sub Phrase: {self.is_sub_prase}"
 
     def __repr__(self):
         return self.__str__()
@@ -18,79 +28,272 @@ class CsvLine:
     @staticmethod
     def from_csv_line(line):
         is_sub_prase = len(line[3]) > 0
-        return CsvLine(line[0], line[1], line[2], is_sub_prase)
+        # CSVs generated before page numbers were recorded have no Page column
+        page = line[4] if len(line) > 4 else ''
+        return CsvLine(line[0], line[1], line[2], is_sub_prase, page)
     
     @staticmethod
     def from_csv_file(file_path):
+        return list(CsvLine.iter_csv_file(file_path))
+
+    @staticmethod
+    def iter_csv_file(file_path):
         with open(file_path, mode='r', newline='\n', encoding='utf-8-sig') as file:
             reader = csv.reader(file, delimiter=';')
-            return [CsvLine.from_csv_line(line) for line in reader]
+            for line in reader:
+                yield CsvLine.from_csv_line(line)
+
+def get_no_fields(csv_line):
+    return ()
+
+class FlashcardTemplate:
+    """A format string compiled once, so rendering a line is a single %-substitution instead of a str.format parse."""
+    FIELDS = ('text', 'pinyin', 'translation', 'page')
+
+    def __init__(self, template):
+        self.template = template
+        self.pattern = None
+
+        parts = []
+        fields = []
+        try:
+            for literal, field, format_spec, conversion in string.Formatter().parse(template):
+                parts.append(literal.replace('%', '%%'))
+                if field is None:
+                    continue
+                if field not in FlashcardTemplate.FIELDS or format_spec or conversion:
+                    # e.g. "{text!r}" or "{translation:>20}", which are left to str.format
+                    return
+                parts.append('%s')
+                fields.append(field)
+        except ValueError:
+            # Malformed (e.g. an unmatched brace), str.format reports the error when rendering
+            return
+
+        self.pattern = ''.join(parts)
+        # A module level function rather than a lambda, so templates can be sent to worker processes
+        self.get_fields = operator.attrgetter(*fields) if fields else get_no_fields
+
+    def render(self, csv_line):
+        if self.pattern is None:
+            return self.template.format(
+                text=csv_line.text, 
+                pinyin=csv_line.pinyin, 
+                translation=csv_line.translation,
+                page=csv_line.page)
+        return self.pattern % self.get_fields(csv_line)
 
 class FlashcardGenerator:
     SKIP_SEGMENTED = False
     TEMPLATE = "{text}\t{translation}\n"
+    _compiled_template = None
+
+    @staticmethod
+    def get_template():
+        # Recompiled only when TEMPLATE is changed (e.g. by the UI)
+        compiled_template = FlashcardGenerator._compiled_template
+        if compiled_template is None or compiled_template.template != FlashcardGenerator.TEMPLATE:
+            compiled_template = FlashcardGenerator._compiled_template = FlashcardTemplate(FlashcardGenerator.TEMPLATE)
+        return compiled_template
 
     @staticmethod
     def generate_flashcard(csv_line):
-        return FlashcardGenerator.TEMPLATE.format(
-            text=csv_line.text, 
-            pinyin=csv_line.pinyin, 
-            translation=csv_line.translation)
+        return FlashcardGenerator.get_template().render(csv_line)
     
     @staticmethod
     def generate_flashcards(csv_lines):
-        filtered_lines = [line for line in csv_lines if not line.is_sub_prase] if FlashcardGenerator.SKIP_SEGMENTED else csv_lines
-        return [FlashcardGenerator.generate_flashcard(line) for line in filtered_lines]
+        return list(FlashcardGenerator.iter_flashcards(csv_lines))
+
+    @staticmethod
+    def iter_flashcards(csv_lines):
+        template = FlashcardGenerator.get_template()
+        for line in csv_lines:
+            if not (FlashcardGenerator.SKIP_SEGMENTED and line.is_sub_prase):
+                yield template.render(line)
+
+class Deck:
+    """A named output profile: where its TXTs go, the flashcard template and whether segmented phrases are skipped."""
+
+    def __init__(self, name, output_directory, template, skip_segmented):
+        self.name = name
+        self.output_directory = output_directory
+        self.template = FlashcardTemplate(template)
+        self.skip_segmented = skip_segmented
+
+    def get_settings(self):
+        return {
+            'template': self.template.template,
+            'skip_segmented': self.skip_segmented,
+        }
+
+    @staticmethod
+    def from_generator_settings(output_directory):
+        return Deck('default', output_directory, FlashcardGenerator.TEMPLATE, FlashcardGenerator.SKIP_SEGMENTED)
+
+def parse_format_string(format_string):
+    return format_string.replace("\\n", "\n").replace("\\t", "\t") + "\n"
+
+def load_decks(file_path, default_output_directory):
+    """Loads the decks from a JSON object of the form {name: {"output_directory", "format", "skip_segmented"}}.
+
+    Decks without an output directory are written to a subdirectory (named after the deck) of default_output_directory.
+    """
+    with open(file_path, mode='r', encoding='utf-8') as file:
+        definitions = json.load(file)
+
+    if not isinstance(definitions, dict) or not definitions:
+        raise ValueError('The decks file must contain an object with at least one deck')
+
+    decks = []
+    for name, definition in definitions.items():
+        format_string = definition.get('format', "{text}\t{translation}")
+        if len(format_string) == 0:
+            raise ValueError(f"The format string of deck '{name}' is empty")
+
+        output_directory = definition.get('output_directory') or os.path.join(default_output_directory, name)
+        decks.append(Deck(name, output_directory, parse_format_string(format_string), bool(definition.get('skip_segmented', False))))
+
+    output_directories = [os.path.abspath(deck.output_directory) for deck in decks]
+    if len(set(output_directories)) != len(output_directories):
+        raise ValueError('Every deck must have its own output directory')
+
+    return decks
 
 def deduplicate(csv_lines): 
+    return list(iter_deduplicated(csv_lines))
+
+def iter_deduplicated(csv_lines):
+    # Only a compact 8 byte hash of each text is kept, so memory stays flat for very large files
     seen = set()
-    deduplicated = []
     for line in csv_lines:
-        if line.text not in seen:
-            seen.add(line.text)
-            deduplicated.append(line)
-    return deduplicated
+        text_hash = hashlib.blake2b(line.text.encode('utf-8'), digest_size=8).digest()
+        if text_hash not in seen:
+            seen.add(text_hash)
+            yield line
+
+def get_txt_file_path(csv_path, output_directory):
+    csv_file_name = os.path.basename(csv_path)
+    txt_file_name = csv_file_name.replace('.csv', '.txt')
+    return os.path.join(output_directory, txt_file_name)
 
 def process_file(csv_path, output_directory):
+    return process_file_for_decks(csv_path, [Deck.from_generator_settings(output_directory)])[0]
+
+def process_file_for_decks(csv_path, decks):
+    """Renders every deck from a single read of the CSV, returns the TXT paths in the order of decks."""
     print("\nProcessing file: ", csv_path)
 
+    # Rows are read, deduplicated, rendered and written in a single streaming pass
     try: 
-        lines = CsvLine.from_csv_file(csv_path)
+        lines = CsvLine.iter_csv_file(csv_path)
+        header = next(lines, None)
     except Exception as e:
         raise Exception(f"An error occurred while reading the CSV file: {e}")
     
-    if not lines:
+    if header is None:
         raise Exception('No lines found in the CSV file')
-    
-    filtered_lines = deduplicate(lines[1:])
-    
-    flashcards = FlashcardGenerator.generate_flashcards(filtered_lines)
 
-    csv_file_name = os.path.basename(csv_path)
-    txt_file_name = csv_file_name.replace('.csv', '.txt')
-    txt_file_path = os.path.join(output_directory, txt_file_name)
+    txt_file_paths = [get_txt_file_path(csv_path, deck.output_directory) for deck in decks]
     
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
+    # Worker processes may create the same directory at the same time
+    for deck in decks:
+        if deck.output_directory:
+            os.makedirs(deck.output_directory, exist_ok=True)
+
+    # Written to temporary files first, so a failure halfway never leaves a truncated TXT behind
+    temporary_txt_file_paths = [txt_file_path + '.tmp' for txt_file_path in txt_file_paths]
+    try:
+        with ExitStack() as stack:
+            outputs = []
+            for deck, temporary_txt_file_path in zip(decks, temporary_txt_file_paths):
+                txt_file = stack.enter_context(open(temporary_txt_file_path, mode='w', newline='\n', encoding='utf-8'))
+                outputs.append((txt_file.write, deck.template.render, deck.skip_segmented))
 
-    with open(txt_file_path, mode='w', newline='\n', encoding='utf-8') as txt_file:
-            txt_file.writelines(flashcards)
+            for line in iter_deduplicated(lines):
+                for write, render, skip_segmented in outputs:
+                    if not (skip_segmented and line.is_sub_prase):
+                        write(render(line))
+    except Exception as e:
+        lines.close()
+        for temporary_txt_file_path in temporary_txt_file_paths:
+            if os.path.exists(temporary_txt_file_path):
+                os.remove(temporary_txt_file_path)
+        raise Exception(f"An error occurred while reading the CSV file: {e}")
+
+    for temporary_txt_file_path, txt_file_path in zip(temporary_txt_file_paths, txt_file_paths):
+        os.replace(temporary_txt_file_path, txt_file_path)
+    return txt_file_paths
+
+def get_settings():
+    return {
+        'template': FlashcardGenerator.TEMPLATE,
+        'skip_segmented': FlashcardGenerator.SKIP_SEGMENTED,
+    }
+
+def apply_settings(settings):
+    FlashcardGenerator.TEMPLATE = settings['template']
+    FlashcardGenerator.SKIP_SEGMENTED = settings['skip_segmented']
 
-    return txt_file_path
+def process_files_in_pool(decks_by_csv_path, jobs, on_processed=None):
+    """Processes the files in worker processes, returns the TXT paths of every CSV in the order of decks_by_csv_path."""
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(process_file_for_decks, csv_path, decks): csv_path for csv_path, decks in decks_by_csv_path.items()}
 
-def main(path, output_directory): 
+        for completed, future in enumerate(as_completed(futures), start=1):
+            print(f"[{completed}/{len(futures)}] Finished: {', '.join(future.result())}")
+            if on_processed is not None:
+                on_processed(futures[future], future.result())
+
+        return [future.result() for future in futures]
+
+def find_csv_paths(path):
+    """Returns the CSVs of a directory (sorted by name) or the CSV itself, raises ValueError if there are none."""
     if os.path.isdir(path):
-        csv_files = [f for f in os.listdir(path) if f.endswith('.csv')]
+        csv_files = sorted(f for f in os.listdir(path) if f.endswith('.csv'))
         if not csv_files:
-            print('No CSV files found in the directory')
-            sys.exit(1)
-        for csv_file in csv_files:
-            process_file(os.path.join(path, csv_file), output_directory)
-    else:
-        if not os.path.isfile(path):
-            print('The provided path is not a valid file or directory')
-            sys.exit(1)
-        process_file(path, output_directory)
+            raise ValueError('No CSV files found in the directory')
+        return [os.path.join(path, csv_file) for csv_file in csv_files]
+
+    if not os.path.isfile(path):
+        raise ValueError('The provided path is not a valid file or directory')
+    return [path]
+
+def main(path, decks, jobs=1, incremental=False): 
+    try:
+        csv_paths = find_csv_paths(path)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    decks_by_csv_path = {csv_path: decks for csv_path in csv_paths}
+
+    manifests = {}
+    if incremental:
+        manifests = {deck.output_directory: BuildManifest(deck.output_directory) for deck in decks}
+
+        # A CSV is read again only for the decks whose TXT is out of date
+        for csv_path in csv_paths:
+            outdated_decks = [deck for deck in decks if not manifests[deck.output_directory].is_up_to_date(
+                csv_path, get_txt_file_path(csv_path, deck.output_directory), deck.get_settings())]
+            if outdated_decks:
+                decks_by_csv_path[csv_path] = outdated_decks
+            else:
+                print("Up to date: ", csv_path)
+                del decks_by_csv_path[csv_path]
+
+    def record_processed(csv_path, txt_file_paths):
+        for deck, txt_file_path in zip(decks_by_csv_path[csv_path], txt_file_paths):
+            manifest = manifests.get(deck.output_directory)
+            if manifest is not None:
+                manifest.record(csv_path, txt_file_path, deck.get_settings())
+                manifest.save()
+
+    if jobs > 1 and len(decks_by_csv_path) > 1:
+        process_files_in_pool(decks_by_csv_path, jobs, record_processed)
+        return
+
+    for csv_path, csv_decks in decks_by_csv_path.items():
+        record_processed(csv_path, process_file_for_decks(csv_path, csv_decks))
 
 if __name__ == "__main__":
     # Get csv/directory path from arguments 
@@ -130,17 +333,75 @@ if __name__ == "__main__":
                 print("Please provide a valid format string")
                 sys.exit(1)
 
-            FlashcardGenerator.TEMPLATE = format_string.replace("\\n", "\n").replace("\\t", "\t") + "\n"
+            FlashcardGenerator.TEMPLATE = parse_format_string(format_string)
         else:
             print('Please provide a valid format string')
             sys.exit(1)
     else: 
-        print("Using default format string")
+        if '--decks' not in sys.argv:
+            print("Using default format string")
         FlashcardGenerator.TEMPLATE = "{text}\t{translation}\n"
     
     # --skip-segmented
     if '--skip-segmented' in sys.argv:
         print("Skipping segmented phrases")
         FlashcardGenerator.SKIP_SEGMENTED = True
+
+    # --jobs [number]
+    jobs = 1
+    if '--jobs' in sys.argv:
+        jobs_index = sys.argv.index('--jobs') + 1
+        if jobs_index < len(sys.argv) and sys.argv[jobs_index].isdigit() and int(sys.argv[jobs_index]) > 0:
+            jobs = int(sys.argv[jobs_index])
+        else:
+            print('Please provide a valid number of jobs (positive integer)')
+            sys.exit(1)
         
-    main(file_path, output_directory)
\ No newline at end of file
+    # --incremental
+    incremental = '--incremental' in sys.argv
+
+    # --decks [path]
+    if '--decks' in sys.argv:
+        decks_index = sys.argv.index('--decks') + 1
+        if decks_index >= len(sys.argv) or "--" in sys.argv[decks_index]:
+            print('Please provide a valid path to a decks file')
+            sys.exit(1)
+
+        try:
+            decks = load_decks(sys.argv[decks_index], output_directory)
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Could not load the decks file: {e}")
+            sys.exit(1)
+        print("Generating decks: ", ', '.join(deck.name for deck in decks))
+    else:
+        decks = [Deck.from_generator_settings(output_directory)]
+
+    for deck in decks:
+        try:
+            deck.template.render(CsvLine('', '', '', False))
+        except (KeyError, IndexError, ValueError) as e:
+            print(f"Please provide a valid format string ({deck.name}: {e})")
+            sys.exit(1)
+
+    # --service [url]
+    if '--service' in sys.argv:
+        service_index = sys.argv.index('--service') + 1
+        if service_index >= len(sys.argv) or "--" in sys.argv[service_index]:
+            print('Please provide a valid service URL')
+            sys.exit(1)
+
+        # Imported here, so other runs never load the HTTP stack
+        from service_client import EnrichmentServiceClient, ServiceError
+
+        try:
+            txt_file_paths = EnrichmentServiceClient(sys.argv[service_index]).flashcards(file_path, decks, incremental)
+        except ServiceError as e:
+            print(f"The enrichment service failed: {e}")
+            sys.exit(1)
+
+        for csv_txt_file_paths in txt_file_paths.values():
+            for txt_file_path in csv_txt_file_paths:
+                print("Flashcards generated: ", txt_file_path)
+        sys.exit(0)
+
+    main(file_path, decks, jobs, incremental)
\ No newline at end of file
@@ -0,0 +1,138 @@
+import json
+import math
+import time
+
+# Histogram buckets grow by 10% from one microsecond, so percentiles are accurate to about 10%
+BUCKET_BASE = 1e-6
+BUCKET_GROWTH = math.log(1.1)
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class Timer:
+    def __init__(self, profiler, stage):
+        self.profiler = profiler
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.profiler.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+class Profiler:
+    """Collects counters and timing histograms per stage.
+
+    While disabled, count() returns immediately and time() hands out a shared no-op timer.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, amount=1):
+        # Zero amounts (e.g. no cache lookups at all) would only show up as empty counters
+        if self.enabled and amount:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def time(self, stage):
+        return Timer(self, stage) if self.enabled else NULL_TIMER
+
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = {'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': {}}
+
+        bucket = max(0, int(math.log(max(seconds, BUCKET_BASE) / BUCKET_BASE) / BUCKET_GROWTH))
+        histogram['count'] += 1
+        histogram['total'] += seconds
+        histogram['max'] = max(histogram['max'], seconds)
+        histogram['buckets'][bucket] = histogram['buckets'].get(bucket, 0) + 1
+
+    def snapshot(self):
+        """Returns the raw data (e.g. to send it from a worker process to the parent)."""
+        return {'counters': dict(self.counters), 'histograms': json.loads(json.dumps(self.histograms))}
+
+    def merge(self, snapshot):
+        for name, amount in snapshot['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+        for stage, other in snapshot['histograms'].items():
+            histogram = self.histograms.setdefault(stage, {'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': {}})
+            histogram['count'] += other['count']
+            histogram['total'] += other['total']
+            histogram['max'] = max(histogram['max'], other['max'])
+            for bucket, amount in other['buckets'].items():
+                histogram['buckets'][int(bucket)] = histogram['buckets'].get(int(bucket), 0) + amount
+
+    def report(self):
+        timings = {}
+        for stage, histogram in sorted(self.histograms.items()):
+            timings[stage] = {
+                'count': histogram['count'],
+                'total_ms': histogram['total'] * 1000,
+                'mean_ms': histogram['total'] / histogram['count'] * 1000,
+                'p50_ms': estimate_percentile(histogram, 0.50) * 1000,
+                'p90_ms': estimate_percentile(histogram, 0.90) * 1000,
+                'p99_ms': estimate_percentile(histogram, 0.99) * 1000,
+                'max_ms': histogram['max'] * 1000,
+            }
+
+        hit_rates = {}
+        for name in sorted(self.counters):
+            if name.endswith('.hit'):
+                prefix = name[:-len('.hit')]
+                hits = self.counters[name]
+                misses = self.counters.get(prefix + '.miss', 0)
+                if hits + misses:
+                    hit_rates[prefix] = hits / (hits + misses)
+
+        return {'counters': dict(sorted(self.counters.items())), 'hit_rates': hit_rates, 'timings': timings}
+
+    def print_report(self):
+        report = self.report()
+
+        print(f"\n{'Stage':<36}{'Count':>8}{'Total ms':>12}{'Mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'Max ms':>10}")
+        for stage, timing in report['timings'].items():
+            print(f"{stage:<36}{timing['count']:>8}{timing['total_ms']:>12.1f}{timing['mean_ms']:>10.2f}"
+                  f"{timing['p50_ms']:>10.2f}{timing['p90_ms']:>10.2f}{timing['p99_ms']:>10.2f}{timing['max_ms']:>10.2f}")
+
+        print(f"\n{'Counter':<40}{'Value':>10}")
+        for name, value in report['counters'].items():
+            print(f"{name:<40}{value:>10}")
+
+        print(f"\n{'Cache':<40}{'Hit rate':>10}")
+        for name, hit_rate in report['hit_rates'].items():
+            print(f"{name:<40}{hit_rate:>10.1%}")
+
+    def write_json(self, file_path):
+        with open(file_path, mode='w', encoding='utf-8') as file:
+            json.dump(self.report(), file, indent=2)
+
+def estimate_percentile(histogram, fraction):
+    target = fraction * histogram['count']
+    seen = 0
+    for bucket in sorted(histogram['buckets']):
+        seen += histogram['buckets'][bucket]
+        if seen >= target:
+            # Upper bound of the bucket, but never above the largest value seen
+            return min(BUCKET_BASE * math.exp((bucket + 1) * BUCKET_GROWTH), histogram['max'])
+    return histogram['max']
+
+# Shared by all modules of the generator
+profiler = Profiler()
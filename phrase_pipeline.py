@@ -0,0 +1,93 @@
+import asyncio
+import itertools
+from instrumentation import profiler
+
+class PhrasePipeline:
+    """Runs the phrases of a file through overlapping parse, enrichment and write stages.
+
+    The parse stage pulls phrases from a (lazily parsed) PDF on a worker thread, WORKERS
+    enrichment workers enrich them concurrently and a writer writes them in document order.
+    The stages are connected by queues of at most QUEUE_SIZE items, so a stage that falls behind
+    holds up the stages before it. At most WORKERS + 2 * QUEUE_SIZE phrases are between parsing
+    and writing, also while the writer waits for a slow phrase.
+    """
+    WORKERS = 16
+    QUEUE_SIZE = 64
+    PARSE_CHUNK = 32
+
+    def __init__(self, enrich, write, on_idle=None):
+        """enrich(item) is awaited for every item, write(item, result) called in order, on_idle() whenever the writer has to wait."""
+        self.enrich = enrich
+        self.write = write
+        self.on_idle = on_idle
+
+    async def run(self, items):
+        """Runs the items (an iterator that may block, e.g. while parsing) through the stages, returns how many were written."""
+        workers = PhrasePipeline.WORKERS
+        self.parsed = asyncio.Queue(PhrasePipeline.QUEUE_SIZE)
+        self.enriched = asyncio.Queue(PhrasePipeline.QUEUE_SIZE)
+        self.window = asyncio.Semaphore(workers + 2 * PhrasePipeline.QUEUE_SIZE)
+
+        tasks = [asyncio.ensure_future(self._parse(items, workers)),
+                 *(asyncio.ensure_future(self._enrich()) for _ in range(workers))]
+        writer = asyncio.ensure_future(self._write(workers))
+        try:
+            await asyncio.gather(*tasks, writer)
+        finally:
+            # One failing stage stops the others instead of leaving them waiting on their queues
+            for task in (*tasks, writer):
+                task.cancel()
+        return writer.result()
+
+    async def _parse(self, items, workers):
+        def parse_chunk():
+            with profiler.time('pipeline.parse'):
+                return list(itertools.islice(items, PhrasePipeline.PARSE_CHUNK))
+
+        index = 0
+        while True:
+            chunk = await asyncio.to_thread(parse_chunk)
+            if not chunk:
+                break
+
+            for item in chunk:
+                await self.window.acquire()
+                await self.parsed.put((index, item))
+                index += 1
+
+        for _ in range(workers):
+            await self.parsed.put(None)
+
+    async def _enrich(self):
+        while True:
+            entry = await self.parsed.get()
+            if entry is None:
+                await self.enriched.put(None)
+                return
+
+            index, item = entry
+            await self.enriched.put((index, item, await self.enrich(item)))
+
+    async def _write(self, workers):
+        # Phrases finished out of order wait here for the phrases before them
+        finished = {}
+        written = 0
+        running_workers = workers
+        while running_workers:
+            if self.enriched.empty() and self.on_idle is not None:
+                # Nothing can be written while waiting, so whatever is buffered might as well be on disk
+                self.on_idle()
+
+            entry = await self.enriched.get()
+            if entry is None:
+                running_workers -= 1
+                continue
+
+            index, item, result = entry
+            finished[index] = (item, result)
+            while written in finished:
+                self.write(*finished.pop(written))
+                written += 1
+                self.window.release()
+
+        return written
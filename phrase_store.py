@@ -0,0 +1,139 @@
+import sys
+from instrumentation import profiler
+
+class PhraseRecord:
+    __slots__ = ('pinyin', 'translation', 'sub_phrases', 'characters')
+
+    def __init__(self, pinyin, translation, sub_phrases, characters):
+        self.pinyin = pinyin
+        self.translation = translation
+        self.sub_phrases = sub_phrases
+        self.characters = characters
+
+class PhraseStore:
+    """Bounded in-memory store of enriched phrases, evicting the least recently used phrase first.
+
+    Records are slotted and their strings interned, so a text is held once however many phrases
+    it appears in. Sub phrases are stored as the texts (keys) of their own records with their
+    reading in the phrase (None for a phrase that was never segmented), and a phrase whose sub
+    phrases have been evicted counts as missing. Either limit may be None (unbounded): max_entries limits the number of phrases,
+    max_characters the total length of their texts, pinyin and translations.
+    """
+    EVICTION_FRACTION = 0.1
+
+    def __init__(self, max_entries=None, max_characters=None):
+        # Plain dicts keep insertion order, so re-inserting a phrase makes it the most recently used
+        self.records = {}
+        self.max_entries = max_entries
+        self.max_characters = max_characters
+        self.characters = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, text):
+        return text in self.records
+
+    def get(self, text):
+        """Returns (pinyin, translation, sub_phrases) of a stored phrase, or None.
+
+        sub_phrases is a list of (text, pinyin, translation), or None if the phrase was never segmented.
+        The pinyin of a sub phrase is its reading in the phrase, the translation that of its own record.
+        """
+        record = self.records.get(text)
+        if record is None:
+            self.misses += 1
+            return None
+
+        sub_phrases = None
+        if record.sub_phrases is not None:
+            sub_phrases = []
+            for sub_text, sub_pinyin in record.sub_phrases:
+                sub_record = self.records.get(sub_text)
+                if sub_record is None:
+                    self._remove(text)
+                    self.misses += 1
+                    return None
+
+                self.records[sub_text] = self.records.pop(sub_text)
+                sub_phrases.append((sub_text, sub_pinyin, sub_record.translation))
+
+        self.records[text] = self.records.pop(text)
+        self.hits += 1
+        return record.pinyin, record.translation, sub_phrases
+
+    def add(self, text, pinyin, translation, sub_phrases=None):
+        """Stores a phrase, replacing a stored phrase with the same text. The sub phrases ((text, pinyin) pairs) must be stored themselves."""
+        text = sys.intern(text)
+        sub_phrases = PhraseStore._intern_sub_phrases(sub_phrases) if sub_phrases is not None else None
+        record = PhraseRecord(sys.intern(pinyin), sys.intern(translation or ''), sub_phrases,
+                              len(text) + len(pinyin) + len(translation or '') + PhraseStore._count_characters(sub_phrases))
+
+        if text in self.records:
+            self._remove(text)
+        self.records[text] = record
+        self.characters += record.characters
+        self._evict()
+
+    def set_sub_phrases(self, text, sub_phrases):
+        """Sets the sub phrases ((text, pinyin) pairs, the pinyin being their reading in the phrase) of a stored phrase."""
+        record = self.records.get(text)
+        if record is not None:
+            sub_phrases = PhraseStore._intern_sub_phrases(sub_phrases)
+            characters = PhraseStore._count_characters(sub_phrases) - PhraseStore._count_characters(record.sub_phrases)
+            record.sub_phrases = sub_phrases
+            record.characters += characters
+            self.characters += characters
+            self._evict()
+
+    @staticmethod
+    def _intern_sub_phrases(sub_phrases):
+        return tuple((sys.intern(sub_text), sys.intern(sub_pinyin)) for sub_text, sub_pinyin in sub_phrases)
+
+    @staticmethod
+    def _count_characters(sub_phrases):
+        # The sub phrase texts are held by their own records, their readings by the phrase
+        return sum(len(sub_pinyin) for _, sub_pinyin in sub_phrases or ())
+
+    def resize(self, max_entries=None, max_characters=None):
+        self.max_entries = max_entries
+        self.max_characters = max_characters
+        self._evict()
+
+    def clear(self):
+        self.records.clear()
+        self.characters = 0
+
+    def stats(self):
+        return {'entries': len(self.records), 'characters': self.characters,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _remove(self, text):
+        self.characters -= self.records.pop(text).characters
+
+    def _is_over_limit(self, entries, characters, fraction=1.0):
+        return (self.max_entries is not None and entries > self.max_entries * fraction) \
+            or (self.max_characters is not None and characters > self.max_characters * fraction)
+
+    def _evict(self):
+        if not self._is_over_limit(len(self.records), self.characters):
+            return
+
+        # Evicts down to 90% of the limits at once, as the oldest key of a dict gets slow to
+        # find after many deletions from its front. The most recently added phrase is always kept.
+        entries, characters = len(self.records), self.characters
+        evicted_texts = []
+        for text, record in self.records.items():
+            if entries <= 1 or not self._is_over_limit(entries, characters, 1 - PhraseStore.EVICTION_FRACTION):
+                break
+            evicted_texts.append(text)
+            entries -= 1
+            characters -= record.characters
+
+        for text in evicted_texts:
+            self._remove(text)
+        self.evictions += len(evicted_texts)
+        profiler.count('cache.phrase.eviction', len(evicted_texts))
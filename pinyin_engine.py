@@ -0,0 +1,133 @@
+import unicodedata
+from dictionary_index import DictionaryIndex, WORD_END
+from instrumentation import profiler
+
+# CJK Unified Ideographs (U+4E00 to U+9FFF), the block nearly all course material is written in
+TABLE_START = 0x4E00
+TABLE_END = 0xA000
+
+class PinyinEngine:
+    """Converts Chinese text to pinyin with one syllable per character.
+
+    The syllables of the main CJK block are computed once into a table indexed by code point (the
+    same syllable string is shared by every character that reads that way), other characters are
+    memoized as they are seen. Phrase level overrides (e.g. corrected heteronyms from cache.csv)
+    replace the syllables of the longest override matching at each position of a text.
+    """
+
+    def __init__(self, overrides=None):
+        self.table = None
+        self.other_syllables = {}
+        self.exact_overrides = {}
+        self.override_index = DictionaryIndex()
+        self.override_syllables = {}
+
+        self.add_overrides((overrides or {}).items())
+
+    def add_override(self, text, pinyin_text):
+        self.exact_overrides[text] = pinyin_text
+
+        # Only overrides with a syllable per character can be applied inside longer texts
+        syllables = pinyin_text.split(' ')
+        if len(syllables) == len(text):
+            self.override_index.add(text)
+            self.override_syllables[text] = syllables
+
+    def add_overrides(self, overrides):
+        for text, pinyin_text in overrides:
+            self.add_override(text, pinyin_text)
+
+    def _build_table(self):
+        import pinyin
+
+        shared = {}
+        self.table = tuple(shared.setdefault(syllable, syllable)
+                           for syllable in (pinyin.get(chr(code_point)) for code_point in range(TABLE_START, TABLE_END)))
+
+    def _other_syllable(self, char):
+        syllable = self.other_syllables.get(char)
+        if syllable is None:
+            syllable = self.other_syllables[char] = self._read_other(char)
+        return syllable
+
+    def _read_other(self, char):
+        # Compatibility ideographs read like the unified ideograph they stand for
+        canonical_char = unicodedata.normalize('NFC', char)
+        if len(canonical_char) == 1 and TABLE_START <= ord(canonical_char) < TABLE_END:
+            return self.table[ord(canonical_char) - TABLE_START]
+
+        import pinyin
+        try:
+            return pinyin.get(canonical_char)
+        except RuntimeError:
+            # pinyin fails on a few rare characters (e.g. U+343B), which are then left as they are
+            return char
+
+    def syllables(self, text):
+        """Returns the syllables of text, a list with one entry per character."""
+        if self.table is None:
+            self._build_table()
+
+        table = self.table
+        syllables = []
+        for char in text:
+            code_point = ord(char)
+            if TABLE_START <= code_point < TABLE_END:
+                syllables.append(table[code_point - TABLE_START])
+            else:
+                syllables.append(self._other_syllable(char))
+
+        if self.override_syllables:
+            self._apply_overrides(text, syllables)
+        return syllables
+
+    def _apply_overrides(self, text, syllables):
+        # Left to right, the longest override starting at a position wins and matching continues after it
+        length = len(text)
+        start = 0
+        while start < length:
+            node = self.override_index.root
+            end = None
+            for position in range(start, length):
+                node = node.get(text[position])
+                if node is None:
+                    break
+                if WORD_END in node:
+                    end = position + 1
+
+            if end is None:
+                start += 1
+                continue
+
+            syllables[start:end] = self.override_syllables[text[start:end]]
+            profiler.count('pinyin.override')
+            start = end
+
+    def get(self, text):
+        """Returns the pinyin of text with the syllables separated by spaces, like pinyin.get(text, delimiter=' ')."""
+        exact_override = self.exact_overrides.get(text)
+        if exact_override is not None:
+            return exact_override
+        return ' '.join(self.syllables(text))
+
+    def get_many(self, texts):
+        return [self.get(text) for text in texts]
+
+    def get_with_parts(self, text, parts):
+        """Returns the pinyin of text and the pinyin of each of its parts (substrings of text).
+
+        The parts are sliced from the syllables of text, so they are read the same way as in text
+        (only overrides that cannot be split into syllables are used as they are).
+        """
+        syllables = self.syllables(text)
+        exact_override = self.exact_overrides.get(text)
+
+        parts_pinyin = []
+        for part in parts:
+            start = text.find(part)
+            if start < 0 or (part in self.exact_overrides and part not in self.override_syllables):
+                parts_pinyin.append(self.get(part))
+            else:
+                parts_pinyin.append(' '.join(syllables[start:start + len(part)]))
+
+        return exact_override if exact_override is not None else ' '.join(syllables), parts_pinyin
@@ -0,0 +1,231 @@
+import asyncio
+import email.utils
+import random
+import re
+import threading
+import time
+from instrumentation import profiler
+
+THROTTLE_STATUS_CODES = (429, 503)
+
+# googletrans only reports failed requests in the message of a plain Exception
+STATUS_CODE_PATTERN = re.compile(r'status code "?(\d{3})')
+
+class ThrottledError(Exception):
+    """The service asked to slow down (e.g. HTTP 429 or 503), optionally saying for how many seconds."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitOpenError(Exception):
+    pass
+
+def parse_retry_after(value):
+    """Returns the seconds to wait from a Retry-After header (seconds or an HTTP date), or None."""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+def get_status_code(exception):
+    response = getattr(exception, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    if status_code is not None:
+        return status_code
+
+    match = STATUS_CODE_PATTERN.search(str(exception))
+    return int(match.group(1)) if match else None
+
+def classify_error(exception):
+    """Returns 'throttled', 'transient' (worth retrying) or None (retrying would not help)."""
+    if isinstance(exception, ThrottledError):
+        return 'throttled'
+
+    status_code = get_status_code(exception)
+    if status_code is not None:
+        if status_code in THROTTLE_STATUS_CODES:
+            return 'throttled'
+        return 'transient' if status_code >= 500 else None
+
+    # Connection errors and timeouts (requests raises OSError subclasses, httpx raises TransportError subclasses)
+    if isinstance(exception, (OSError, asyncio.TimeoutError)) \
+            or any(cls.__name__ == 'TransportError' for cls in type(exception).__mro__):
+        return 'transient'
+    return None
+
+class AdaptiveRateLimiter:
+    """Token bucket whose rate adapts to what the service tolerates.
+
+    Until the service throttles for the first time, every success raises the rate by 10% (slow
+    start), afterwards by INCREASE_STEP, always up to max_rate. Every throttled response halves
+    the rate (down to min_rate) and pauses all requests for as long as the service asked
+    (Retry-After). Thread safe, and usable from both threads and coroutines.
+    """
+    SLOW_START_FACTOR = 1.1
+    INCREASE_STEP = 0.5
+    DECREASE_FACTOR = 0.5
+
+    def __init__(self, name, rate, max_rate, min_rate=0.5):
+        self.name = name
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.slow_start = True
+        self.tokens = max(1.0, rate)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        """Takes a token and returns how many seconds to wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            # Tokens go negative while requests are waiting for them
+            self.tokens -= 1
+            return max(self.paused_until - now, 0.0) + max(-self.tokens / self.rate, 0.0)
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            if self.slow_start:
+                self.rate = min(self.max_rate, self.rate * AdaptiveRateLimiter.SLOW_START_FACTOR)
+            else:
+                self.rate = min(self.max_rate, self.rate + AdaptiveRateLimiter.INCREASE_STEP)
+
+    def on_throttled(self, retry_after=None):
+        with self.lock:
+            self.slow_start = False
+            self.rate = max(self.min_rate, self.rate * AdaptiveRateLimiter.DECREASE_FACTOR)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+class CircuitBreaker:
+    """Fails calls fast once the service failed FAILURE_THRESHOLD times in a row.
+
+    After RESET_TIMEOUT seconds a single call is let through again, and its outcome closes or reopens the circuit.
+    """
+    FAILURE_THRESHOLD = 5
+    RESET_TIMEOUT = 30
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < CircuitBreaker.RESET_TIMEOUT:
+                profiler.count(f'{self.name}.circuit_open')
+                raise CircuitOpenError(f'{self.name} is unavailable, not trying again for a while')
+
+            # Half open, this call decides
+            self.opened_at = time.monotonic()
+
+    def on_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= CircuitBreaker.FAILURE_THRESHOLD:
+                self.opened_at = time.monotonic()
+
+class ServiceGuard:
+    """Wraps the calls to an external service in a rate limiter, retries and a circuit breaker.
+
+    Throttled and transient failures are retried with exponential backoff and full jitter (or
+    after Retry-After), up to MAX_ATTEMPTS in total. Any other error is raised right away, and
+    the error of the last attempt is raised if all attempts fail, so failed lookups are never
+    mistaken for results.
+    """
+    MAX_ATTEMPTS = 5
+    BASE_DELAY = 0.5
+    MAX_DELAY = 30
+
+    def __init__(self, name, rate, max_rate):
+        self.name = name
+        self.limiter = AdaptiveRateLimiter(name, rate, max_rate)
+        self.breaker = CircuitBreaker(name)
+
+    def _on_error(self, exception, attempt):
+        """Records a failed attempt, returns the seconds to wait before retrying (None to give up)."""
+        kind = classify_error(exception)
+        if kind is None:
+            return None
+
+        retry_after = None
+        if kind == 'throttled':
+            # The service is up and said when to come back, which the limiter takes care of. Only
+            # outages open the circuit, or a burst of concurrent throttled requests would open it
+            profiler.count(f'{self.name}.throttled')
+            retry_after = getattr(exception, 'retry_after', None)
+            self.limiter.on_throttled(retry_after)
+        else:
+            self.breaker.on_failure()
+
+        if attempt + 1 >= ServiceGuard.MAX_ATTEMPTS:
+            return None
+
+        profiler.count(f'{self.name}.retry')
+        delay = random.uniform(0, min(ServiceGuard.MAX_DELAY, ServiceGuard.BASE_DELAY * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    def _on_success(self):
+        self.breaker.on_success()
+        self.limiter.on_success()
+
+    def call(self, function, *arguments, **keyword_arguments):
+        for attempt in range(ServiceGuard.MAX_ATTEMPTS):
+            self.breaker.before_call()
+            self.limiter.acquire()
+            try:
+                result = function(*arguments, **keyword_arguments)
+            except Exception as e:
+                delay = self._on_error(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+
+            self._on_success()
+            return result
+
+    async def call_async(self, function, *arguments, **keyword_arguments):
+        for attempt in range(ServiceGuard.MAX_ATTEMPTS):
+            self.breaker.before_call()
+            await self.limiter.acquire_async()
+            try:
+                result = await function(*arguments, **keyword_arguments)
+            except Exception as e:
+                delay = self._on_error(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+
+            self._on_success()
+            return result
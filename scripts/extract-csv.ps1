@@ -1 +1 @@
-py ..\\extract_chinese_from_pdfs.py .\\input-pdf --output-directory .\\output-csv
+py ..\\extract_chinese_from_pdfs.py .\\input-pdf --output-directory .\\output-csv --incremental
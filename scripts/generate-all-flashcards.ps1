@@ -0,0 +1 @@
+py ..\generate_flashcards_from_csvs.py .\output-csv\ --decks .\decks.json --incremental
\ No newline at end of file
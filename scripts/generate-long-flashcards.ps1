@@ -1 +1 @@
-py ..\generate_flashcards_from_csvs.py .\output-csv\ --output-directory .\output-long-flashcards --format "{text}\t{text} ({pinyin}) - {translation}\n{translation}\t{text} ({pinyin})"
+py ..\generate_flashcards_from_csvs.py .\output-csv\ --output-directory .\output-long-flashcards --format "{text}\t{text} ({pinyin}) - {translation}\n{translation}\t{text} ({pinyin})" --incremental
@@ -0,0 +1,64 @@
+import json
+import os
+import urllib.error
+import urllib.request
+
+class ServiceError(Exception):
+    pass
+
+class EnrichmentServiceClient:
+    """Sends jobs to a running enrichment service (see enrichment_service.py).
+
+    Uses urllib rather than requests, so a thin client starts without importing an HTTP stack.
+    Paths are sent as absolute paths, as the service reads and writes the files itself.
+    """
+    HEALTH_TIMEOUT = 5
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def _request(self, path, body=None, timeout=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.load(e)['error']
+            except (ValueError, KeyError, TypeError):
+                message = str(e)
+            raise ServiceError(message) from e
+        except urllib.error.URLError as e:
+            raise ServiceError(f"The enrichment service at {self.url} is not reachable ({e.reason})") from e
+
+    def health(self):
+        return self._request('/health', timeout=EnrichmentServiceClient.HEALTH_TIMEOUT)
+
+    def enrich(self, phrases, skip_translation=False, skip_segmentation=False):
+        """Returns a dict per phrase with its text, pinyin, translation and sub phrases."""
+        return self._request('/enrich', {
+            'phrases': list(phrases),
+            'skip_translation': skip_translation,
+            'skip_segmentation': skip_segmentation,
+        })['phrases']
+
+    def extract(self, path, output_directory, skip_translation=False, skip_segmentation=False, incremental=False, resume=False, corpus=False):
+        """Converts a PDF (or the PDFs of a directory) to CSVs, returns the CSV paths."""
+        return self._request('/extract', {
+            'path': os.path.abspath(path),
+            'output_directory': os.path.abspath(output_directory),
+            'skip_translation': skip_translation,
+            'skip_segmentation': skip_segmentation,
+            'incremental': incremental,
+            'resume': resume,
+            'corpus': corpus,
+        })['csv_file_paths']
+
+    def flashcards(self, path, decks, incremental=False):
+        """Renders the decks from a CSV (or the CSVs of a directory), returns the TXT paths of every CSV."""
+        return self._request('/flashcards', {
+            'path': os.path.abspath(path),
+            'decks': [dict(deck.get_settings(), name=deck.name, output_directory=os.path.abspath(deck.output_directory)) for deck in decks],
+            'incremental': incremental,
+        })['txt_file_paths']
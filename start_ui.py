@@ -2,10 +2,17 @@ import platform
 import streamlit as st 
 from streamlit import session_state
 import os
-from extract_chinese_from_pdfs import ChinesePhrase, process_file_async 
-from generate_flashcards_from_csvs import FlashcardGenerator, process_file
-import asyncio
+import extract_chinese_from_pdfs
+from extract_chinese_from_pdfs import ChinesePhrase
+from generate_flashcards_from_csvs import Deck, parse_format_string, process_file_for_decks
+from background_jobs import JobRunner
+from build_manifest import hash_file, hash_settings
+from service_client import EnrichmentServiceClient
+from instrumentation import profiler
+import hashlib
+import io
 import json
+import zipfile
 
 upload_dir = ".\\uploads"
 
@@ -14,12 +21,70 @@ is_local = environment_value == "local"
 
 print("Running in environment: ", environment_value)
 
+profiler.enabled = os.getenv("PROFILE", "true") == "true"
+
+if extract_chinese_from_pdfs.cache_store is None:
+    extract_chinese_from_pdfs.open_cache_store(os.getenv("CACHE_PATH", extract_chinese_from_pdfs.default_cache_store_path))
+
+dictionary_path = os.getenv("DICTIONARY_PATH")
+if dictionary_path and extract_chinese_from_pdfs.dictionary is None:
+    extract_chinese_from_pdfs.load_dictionary(dictionary_path)
+    ChinesePhrase.SUB_PHRASE_LIMIT = None
+
+# Bounds the phrases kept in memory by every worker process (0 for no limit)
+ChinesePhrase.STORE.resize(int(os.getenv("PHRASE_CACHE_SIZE", "100000")) or None)
+
+# Background jobs (shared by all sessions)
+@st.cache_resource
+def get_job_runner():
+    return JobRunner(max_workers=int(os.getenv("MAX_WORKERS", "2")))
+
+# Convert PDFs through a running enrichment service instead of local worker processes (e.g. http://127.0.0.1:8765)
+service_url = os.getenv("SERVICE_URL")
+
+def get_conversion_output_directory(file_hash: str, skip_translation: bool, skip_segmentation: bool):
+    # One directory per PDF content and options, so same-named uploads (of other sessions) never share a CSV
+    options = ("-skip-translation" if skip_translation else "") + ("-skip-segmentation" if skip_segmentation else "")
+    return os.path.join(".", "uploads-output", file_hash + options)
+
+def convert_pdf_with_service(pdf_file_path: str, output_directory: str, skip_translation: bool, skip_segmentation: bool, job: dict):
+    job['status'] = 'running'
+    csv_file_paths = EnrichmentServiceClient(service_url).extract(
+        pdf_file_path, output_directory, skip_translation=skip_translation, skip_segmentation=skip_segmentation)
+    return csv_file_paths[0]
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def convert_pdf_cached(file_hash: str, skip_translation: bool, skip_segmentation: bool, _pdf_file_path: str, _job: dict):
+    # Only the file hash and options are part of the cache key, so re-uploading the same PDF returns instantly
+    output_directory = get_conversion_output_directory(file_hash, skip_translation, skip_segmentation)
+    if service_url:
+        return convert_pdf_with_service(_pdf_file_path, output_directory, skip_translation, skip_segmentation, _job)
+
+    settings = dict(
+        extract_chinese_from_pdfs.get_settings(), 
+        skip_translation=skip_translation, 
+        skip_segmentation=skip_segmentation, 
+        echo_csv_lines=False, 
+        profile=profiler.enabled)
+    return get_job_runner().run_pdf_conversion(_job, _pdf_file_path, output_directory, settings)
+
+def get_flashcard_output_directory(csv_file_path: str, deck: Deck):
+    # One directory per CSV content and deck settings, so sessions with other templates never overwrite each other's TXT
+    return os.path.join(".", "uploads-output", "flashcards", hash_settings(dict(deck.get_settings(), csv=hash_file(csv_file_path))))
+
+def generate_flashcards(csv_file_path: str, template: str, skip_segmented: bool):
+    # A deck per call rather than the class level FlashcardGenerator settings, which all sessions share
+    deck = Deck("default", None, template, skip_segmented)
+    deck.output_directory = get_flashcard_output_directory(csv_file_path, deck)
+    return process_file_for_decks(csv_file_path, [deck])[0]
+
 # (State) functions
-def save_uploaded_file(file_name: str, buffer): 
-    if not os.path.exists(upload_dir):
-        os.makedirs(upload_dir)
+def save_uploaded_file(file_name: str, buffer, file_hash: str): 
+    # Saved by content, so a same-named upload of another session never replaces a file still being converted
+    file_directory = os.path.join(upload_dir, file_hash)
+    os.makedirs(file_directory, exist_ok=True)
     
-    file_path = os.path.join(upload_dir, file_name)
+    file_path = os.path.join(file_directory, file_name)
     with open(file_path, "wb") as f:
         f.write(buffer)
 
@@ -56,118 +121,215 @@ def get_mode():
 
     return None
 
-def get_pdf_path(): 
-    if session_state.get("pdf_file_path", None) is not None:
-        return session_state.pdf_file_path
-    
-    return None
+def get_uploads():
+    return session_state.get("uploads") or []
+
+def get_pdf_uploads():
+    return [upload for upload in get_uploads() if upload["type"] == "pdf"]
+
+def get_csv_processes():
+    if session_state.get("csv_processes") is None:
+        session_state.csv_processes = {}
+    return session_state.csv_processes
+
+def get_pdf_jobs():
+    jobs = session_state.get("jobs", {})
+    return [
+        jobs[csv_process["job_id"]] 
+        for csv_process in get_csv_processes().values() 
+        if csv_process.get("status") == "started" and csv_process.get("job_id") in jobs]
+
+def sync_pdf_jobs():
+    """Copies the outcome of every finished job to its CSV process, returns True if any job finished since the last call."""
+    jobs = session_state.get("jobs", {})
+    csv_processes = get_csv_processes()
+
+    any_finished = False
+    for file_name, csv_process in csv_processes.items():
+        job = jobs.get(csv_process.get("job_id"))
+        if csv_process.get("status") != "started" or job is None or job["status"] in ("queued", "running"):
+            continue
+
+        if job["status"] == "completed":
+            csv_processes[file_name] = {
+                "status": "completed",
+                "result": job["result"]
+            }
+        else:
+            csv_processes[file_name] = {
+                "status": job["status"],
+                "error": job["error"]
+            }
+        any_finished = True
 
-def get_csv_path():
-    csv_process = session_state.get("csv_process", None)
-    if csv_process is None: 
-        return None 
-    
-    csv_process_status = csv_process.get("status", None)
-    if csv_process_status != "completed":
-        return None
-    
-    return csv_process.get("result")
+    return any_finished
 
-def get_txt_path(): 
+def get_csv_paths():
+    # In upload order, each file as soon as its conversion is done
+    csv_processes = get_csv_processes()
+    return [
+        csv_processes[upload["name"]]["result"] 
+        for upload in get_uploads() 
+        if (csv_processes.get(upload["name"]) or {}).get("status") == "completed"]
+
+def get_txt_paths(): 
     txt_process = session_state.get("txt_process", None)
     if txt_process is None:
-        return None
+        return []
     
     txt_process_status = txt_process.get("status", None)
     if txt_process_status != "completed":
-        return None
+        return []
     
     return txt_process.get("result")
 
-def get_txt_content(): 
-    txt_file_path = get_txt_path()
-    if txt_file_path is None:
-        return None
-    
-    with open(txt_file_path, "r", encoding="utf-8") as file:
+def read_file(file_path):
+    with open(file_path, "r", encoding="utf-8") as file:
         return file.read()
 
-def get_csv_content():
-    csv_file_path = get_csv_path()
-    if csv_file_path is None:
-        return None
-    
-    with open(csv_file_path, "r", encoding="utf-8") as file:
-        return file.read()
+def get_merged_txt_content(): 
+    return "".join(read_file(txt_file_path) for txt_file_path in get_txt_paths())
+
+def create_zip(file_paths):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for file_path in file_paths:
+            zip_file.write(file_path, os.path.basename(file_path))
+    return buffer.getvalue()
+
+def render_result_files(label, file_paths, key):
+    for index, file_path in enumerate(file_paths):
+        col1, col2 = st.columns([6, 2])
+        with col1:
+            st.success(f"{label}: {file_path}")
+        with col2:
+            if is_local: 
+                st.button(
+                    "Open file",
+                    key=f"open_{key}_{index}",
+                    use_container_width=True,
+                    on_click=reveal_file_in_explorer,
+                    args=(file_path,))
+            else: 
+                st.download_button(
+                    "Download file",
+                    read_file(file_path),
+                    os.path.basename(file_path),
+                    key=f"download_{key}_{index}")
 
 # Callbacks 
 def handle_file_upload():
-    file_upload = session_state.get("file_upload", None)
-    if file_upload is None:
+    file_uploads = session_state.get("file_upload", None)
+    if not file_uploads:
         print("Warning, No file uploaded")
         return 
 
     try: 
-        file_name = file_upload.name
-        uploaded_file_path = save_uploaded_file(file_name, file_upload.getbuffer())
+        uploads = []
+        csv_processes = {}
+        for file_upload in file_uploads:
+            file_name = file_upload.name
+            if not (file_name.endswith(".pdf") or file_name.endswith(".csv")):
+                st.error(f"Invalid file format ({file_name}). Please upload PDF or CSV files.")
+                continue
+
+            file_hash = hashlib.sha256(file_upload.getbuffer()).hexdigest()
+            uploaded_file_path = save_uploaded_file(file_name, file_upload.getbuffer(), file_hash)
+
+            if (file_name.endswith(".pdf")):
+                uploads.append({
+                    "name": file_name,
+                    "type": "pdf",
+                    "path": uploaded_file_path,
+                    "hash": file_hash
+                })
+            else:
+                uploads.append({
+                    "name": file_name,
+                    "type": "csv",
+                    "path": uploaded_file_path
+                })
+                csv_processes[file_name] = {
+                    "status": "completed",
+                    "result": uploaded_file_path
+                }
+
+        session_state.uploads = uploads
+        session_state.csv_processes = csv_processes
+        session_state.txt_process = None
 
-        if (file_name.endswith(".pdf")):
+        if any(upload["type"] == "pdf" for upload in uploads):
             session_state.mode = "pdf"
-            session_state.pdf_file_path = uploaded_file_path
-            session_state.csv_process = None
-            session_state.txt_process = None
-            return
-        if (file_name.endswith(".csv")):
+        elif uploads:
             session_state.mode = "csv"
-            session_state.pdf_file_path = None
-            session_state.csv_process = {
-                "status": "completed",
-                "result": uploaded_file_path
-            }
-            session_state.txt_process = None
-            return
-        
-        st.error("Invalid file format. Please upload a PDF or CSV file.")
+        else:
+            session_state.mode = None
 
     except Exception as e:
         st.error(f"An error occurred: {e}")
 
 def handle_pdf_convert(): 
-    pdf_file_path = get_pdf_path()
+    pdf_uploads = get_pdf_uploads()
     skip_translation = session_state.get("skip_translation")
     skip_segmentation = session_state.get("skip_segmentation")
 
-    if pdf_file_path is None:
+    if not pdf_uploads:
         st.error("No PDF file uploaded")
         return
 
-    try: 
-        session_state.csv_process = {
-            "status": "started",
-        }
-        session_state.txt_process = None
-        st.spinner("Processing...") 
-        
-        ChinesePhrase.SKIP_TRANSLATION = skip_translation
-        ChinesePhrase.SKIP_SEGMENTATION = skip_segmentation
-        csv_file_path = asyncio.run(process_file_async(pdf_file_path, os.path.join(".", "uploads-output")))
+    session_state.txt_process = None
+    jobs = session_state.setdefault("jobs", {})
+    csv_processes = get_csv_processes()
+
+    # Every file is a job of its own. They all queue up at once and run MAX_WORKERS at a time
+    for upload in pdf_uploads:
+        try: 
+            job = JobRunner.create_job(upload["name"])
+            jobs[job["id"]] = job
+            csv_processes[upload["name"]] = {
+                "status": "started",
+                "job_id": job["id"]
+            }
 
-        session_state.csv_process = {
-            "status": "completed",
-            "result": csv_file_path
-        }
-    except Exception as e:
-        st.error(f"An error occurred: {e}")
+            get_job_runner().submit(
+                job, 
+                convert_pdf_cached, 
+                upload["hash"], 
+                bool(skip_translation), 
+                bool(skip_segmentation), 
+                upload["path"], 
+                job)
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
+
+            csv_processes[upload["name"]] = {
+                "status": "failed",
+                "error": str(e)
+            }
 
-        session_state.csv_process = {
-            "status": "failed",
-            "error": str(e)
-        }
+def handle_pdf_cancel():
+    for job in get_pdf_jobs():
+        get_job_runner().cancel(job)
+
+def render_pdf_job_status():
+    if sync_pdf_jobs():
+        # Rerun the whole page to show the files finished so far
+        st.rerun()
+
+    pdf_jobs = get_pdf_jobs()
+    if not pdf_jobs:
+        return
+
+    st.info(f"Converting... {len(pdf_jobs)} of {len(get_pdf_uploads())} files remaining")
+    st.table([
+        {"File": job["name"], "Status": job["status"], "Phrases processed": job["progress"]}
+        for job in pdf_jobs])
+    st.button("Cancel", key="cancel_pdf_convert", on_click=handle_pdf_cancel)
 
 def handle_csv_convert(): 
-    csv_file_path = get_csv_path()
+    csv_file_paths = get_csv_paths()
 
-    if csv_file_path is None:
+    if not csv_file_paths:
         st.error("No CSV file uploaded")
         return
     
@@ -177,18 +339,14 @@ def handle_csv_convert():
         }
         st.spinner("Processing...")
 
-        raw_template = session_state.get("translation_template")
-        template = raw_template.strip().replace("\\n", "\n").replace("\\t", "\t") + "\n"
-        FlashcardGenerator.TEMPLATE = template
-        
+        template = parse_format_string(session_state.get("translation_template").strip())
         skip_segmented = session_state.get("skip_segmented", False)
-        FlashcardGenerator.SKIP_SEGMENTED = skip_segmented
 
-        flashcard_file_path = process_file(csv_file_path, "uploads-output")
+        flashcard_file_paths = [generate_flashcards(csv_file_path, template, skip_segmented) for csv_file_path in csv_file_paths]
 
         session_state.txt_process = {
             "status": "completed",
-            "result": flashcard_file_path
+            "result": flashcard_file_paths
         }
     except Exception as e:  
         st.error(f"An error occurred: {e}")
@@ -199,70 +357,73 @@ def handle_csv_convert():
         }
 
 # Setting up application state 
+sync_pdf_jobs()
 mode = get_mode()
-pdf_file_path = get_pdf_path()
-csv_file_path = get_csv_path()
-txt_file_path = get_txt_path()
+pdf_uploads = get_pdf_uploads()
+csv_file_paths = get_csv_paths()
+txt_file_paths = get_txt_paths()
 
 # Debugging
 #print("=====================================")
 #print(f"Mode: {mode}")
-#print(f"PDF: {pdf_file_path}")
-#print(f"CSV: {csv_file_path}")
-#print(f"TXT: {txt_file_path}")
+#print(f"PDFs: {pdf_uploads}")
+#print(f"CSVs: {csv_file_paths}")
+#print(f"TXTs: {txt_file_paths}")
 #print(f"Session State: {session_state}")
 
 # Upload section 
 st.set_page_config(page_title="CH-DA Flashcard Generator")
 
 st.title("CH-DA Flashcard Generator")
-st.write("Upload a PDF or an already generated CSV file to generate flashcards.")
+st.write("Upload PDFs or already generated CSV files to generate flashcards.")
 
 file_upload = st.file_uploader(
-    "Choose CSV/PDF file", 
+    "Choose CSV/PDF files", 
     key="file_upload",
     type=["pdf", "csv"], 
-    accept_multiple_files=False,
+    accept_multiple_files=True,
     on_change=handle_file_upload)
 
 # Generate CSV section
 if mode == "pdf":
-    st.header("1. Generate CSV file")
-    st.write(f"Generate CSV file from PDF (with location \"{pdf_file_path}\")")
+    st.header("1. Generate CSV files")
+    st.write("Generate CSV files from PDFs (" + ", ".join(f"\"{upload['path']}\"" for upload in pdf_uploads) + ")")
 
     skip_segmentation = st.checkbox("Skip segmentation", key="skip_segmentation", value=True)
     skip_translation = st.checkbox("Skip translation", key="skip_translation", value=False)
 
     st.button(
         "Convert", 
+        disabled=len(get_pdf_jobs()) > 0,
         on_click=handle_pdf_convert)
+
+    if get_pdf_jobs():
+        st.fragment(render_pdf_job_status, run_every=1.0)()
+
+    csv_processes = get_csv_processes()
+    for upload in pdf_uploads:
+        csv_process = csv_processes.get(upload["name"]) or {}
+        if csv_process.get("status") == "failed":
+            st.error(f"An error occurred ({upload['name']}): {csv_process.get('error')}")
+        if csv_process.get("status") == "cancelled":
+            st.warning(f"The conversion of {upload['name']} was cancelled")
     
-    if csv_file_path is not None: 
-        col1, col2 = st.columns([6, 2])
-        with col1:
-            st.success(f"CSV file generated: {csv_file_path}")
-        with col2:
-            if is_local: 
-                st.button(
-                    "Open file",
-                    key="open_csv_file",
-                    use_container_width=True,
-                    on_click=lambda: reveal_file_in_explorer(csv_file_path))
-            else: 
-                st.download_button(
-                    "Download file",
-                    get_csv_content(),
-                    "flashcards.csv",
-                    key="download_csv_file")
+    render_result_files("CSV file generated", csv_file_paths, "csv_file")
+    if len(csv_file_paths) > 1 and not is_local:
+        st.download_button(
+            "Download all CSV files (zip)",
+            create_zip(csv_file_paths),
+            "flashcards-csv.zip",
+            key="download_csv_zip")
 
 # Generate Flashcards section
-if csv_file_path is not None:
+if csv_file_paths:
     if mode == "pdf":
         st.header("2. Generate Flashcards")
     if mode == "csv":
         st.header("Generate Flashcards")
 
-    st.text(f"Generate flashcards from CSV (with location \"{csv_file_path}\").")
+    st.text("Generate flashcards from CSVs (with locations " + ", ".join(f"\"{csv_file_path}\"" for csv_file_path in csv_file_paths) + ").")
     st.text(""\
             "The following template will be used to generate flashcards pr. row in the CSV. " \
             "The template allows for the following placeholders and special characters:\n" \
@@ -278,27 +439,37 @@ if csv_file_path is not None:
     st.checkbox("Skip segmented", value=False, key="skip_segmented")
     st.button("Generate Flashcards", on_click=handle_csv_convert)
 
-    if txt_file_path is not None:
-        col1, col2 = st.columns([6, 2])
+    render_result_files("Flashcards generated", txt_file_paths, "flashcard_file")
+    if len(txt_file_paths) > 1 and not is_local:
+        col1, col2 = st.columns(2)
         with col1:
-            st.success(f"Flashcards generated: {txt_file_path}")
+            st.download_button(
+                "Download all flashcard files (zip)",
+                create_zip(txt_file_paths),
+                "flashcards-txt.zip",
+                key="download_flashcard_zip")
         with col2:
-            if is_local:
-                st.button(
-                    "Open file", 
-                    key="open_flashcard_file",
-                    use_container_width=True,
-                    on_click=lambda: reveal_file_in_explorer(txt_file_path))
-            else: 
-                st.download_button(
-                    "Download file",
-                    get_txt_content(),
-                    "flashcards.txt",
-                    key="download_flashcard_file")
+            st.download_button(
+                "Download merged deck",
+                get_merged_txt_content(),
+                "flashcards.txt",
+                key="download_merged_flashcards")
 
-if txt_file_path is not None:
-    txt_content = get_txt_content()
+if txt_file_paths:
+    txt_content = get_merged_txt_content()
 
     st.write("#####")
     st.text_area("Generated Flashcards", txt_content, height=300)
-    create_copy_button(st, "Copy to Clipboard", txt_content)
\ No newline at end of file
+    create_copy_button(st, "Copy to Clipboard", txt_content)
+
+# Performance section
+profile_report = profiler.report()
+if profiler.enabled and profile_report["timings"]:
+    with st.expander("Performance"):
+        st.table([
+            {"Stage": stage, "Count": timing["count"], "Total ms": round(timing["total_ms"], 1), "p50 ms": round(timing["p50_ms"], 2), "p99 ms": round(timing["p99_ms"], 2)}
+            for stage, timing in profile_report["timings"].items()])
+        st.table([
+            {"Cache": name, "Hit rate": f"{hit_rate:.1%}"}
+            for name, hit_rate in profile_report["hit_rates"].items()])
+        st.button("Reset statistics", on_click=profiler.reset)
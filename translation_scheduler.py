@@ -0,0 +1,123 @@
+import asyncio
+from instrumentation import profiler
+from rate_limiter import ServiceGuard
+
+class TranslationScheduler:
+    """Runs translations concurrently on a shared pool of translator clients.
+
+    Texts requested within BATCH_DELAY of each other are sent as a single request (one text per
+    line, up to BATCH_CHARACTERS characters), and a batch whose translation does not split back
+    into one line per text is retried one text at a time. At most CONCURRENCY requests are in
+    flight at once (at the rate the service tolerates, see ServiceGuard), and concurrent requests
+    for the same text share a single translation.
+    """
+    CONCURRENCY = 4
+    BATCH_CHARACTERS = 4500
+    BATCH_DELAY = 0.02
+    SEPARATOR = '\n'
+    RATE = 10
+    MAX_RATE = 100
+
+    def __init__(self, translator_factory):
+        self.translator_factory = translator_factory
+        self.guard = ServiceGuard('translation', TranslationScheduler.RATE, TranslationScheduler.MAX_RATE)
+        self._loop = None
+
+    def _ensure_loop(self):
+        # Semaphores and futures are bound to an event loop, and callers (e.g. the UI)
+        # may start a new loop with asyncio.run for every file
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(TranslationScheduler.CONCURRENCY)
+            self._idle_clients = []
+            self._in_flight = {}
+            self._batches = {}
+            self._tasks = set()
+
+    async def translate(self, text, target_language):
+        self._ensure_loop()
+
+        key = (text, target_language)
+        future = self._in_flight.get(key)
+        if future is not None:
+            profiler.count('translation.coalesced')
+        else:
+            future = self._loop.create_future()
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            self._add_to_batch(text, target_language, future)
+
+        # Shielded so that one cancelled caller does not cancel the request for the others
+        return await asyncio.shield(future)
+
+    def _add_to_batch(self, text, target_language, future):
+        batch = self._batches.get(target_language)
+        if batch is not None and batch['characters'] + len(TranslationScheduler.SEPARATOR) + len(text) > TranslationScheduler.BATCH_CHARACTERS:
+            self._send_batch(target_language)
+            batch = None
+
+        if batch is None:
+            batch = self._batches[target_language] = {
+                'texts': [],
+                'futures': [],
+                'characters': 0,
+                'timer': self._loop.call_later(TranslationScheduler.BATCH_DELAY, self._send_batch, target_language),
+            }
+
+        batch['texts'].append(text)
+        batch['futures'].append(future)
+        batch['characters'] += len(TranslationScheduler.SEPARATOR) + len(text)
+
+        if not TranslationScheduler.BATCH_CHARACTERS:
+            self._send_batch(target_language)
+
+    def _send_batch(self, target_language):
+        batch = self._batches.pop(target_language, None)
+        if batch is None:
+            return
+
+        batch['timer'].cancel()
+        task = asyncio.ensure_future(self._translate_batch(batch['texts'], batch['futures'], target_language))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _translate_batch(self, texts, futures, target_language):
+        try:
+            translations = await self._request_batch(texts, target_language)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, translation in zip(futures, translations):
+            if not future.done():
+                future.set_result(translation)
+
+    async def _request_batch(self, texts, target_language):
+        if len(texts) > 1:
+            translation = await self._request(TranslationScheduler.SEPARATOR.join(texts), target_language)
+            lines = [line.strip() for line in translation.split(TranslationScheduler.SEPARATOR)]
+            if len(lines) == len(texts) and all(lines):
+                profiler.count('translation.batched', len(texts))
+                return lines
+
+            # The translator merged or split lines, so it is unclear which line belongs to which text
+            profiler.count('translation.batch_misaligned')
+
+        return await asyncio.gather(*(self._request(text, target_language) for text in texts))
+
+    async def _request(self, text, target_language):
+        async with self._semaphore:
+            client = self._idle_clients.pop() if self._idle_clients else self.translator_factory()
+            try:
+                translation = await self.guard.call_async(self._translate_with, client, text, target_language)
+            finally:
+                self._idle_clients.append(client)
+
+            return translation.text
+
+    async def _translate_with(self, client, text, target_language):
+        with profiler.time('network.translate'):
+            return await client.translate(text, dest=target_language)
@@ -0,0 +1,82 @@
+from instrumentation import profiler
+from rate_limiter import ServiceGuard, ThrottledError, parse_retry_after, THROTTLE_STATUS_CODES
+
+class WiktionaryClient:
+    """Checks which titles have a Chinese entry on Wiktionary through the MediaWiki query API.
+
+    Up to BATCH_SIZE titles are checked per request, using the categories every Chinese
+    entry is placed in instead of downloading and parsing the rendered pages.
+    """
+    API_URL = 'https://en.wiktionary.org/w/api.php'
+    BATCH_SIZE = 50
+    CHINESE_CATEGORIES = ['Category:Chinese lemmas', 'Category:Chinese non-lemma forms', 'Category:Chinese hanzi']
+    TIMEOUT = 30
+    RATE = 10
+    MAX_RATE = 100
+
+    def __init__(self, api_url=None):
+        self.api_url = api_url or WiktionaryClient.API_URL
+        self.session = None
+        self.guard = ServiceGuard('wiktionary', WiktionaryClient.RATE, WiktionaryClient.MAX_RATE)
+
+    def _get_session(self):
+        if self.session is None:
+            # Imported on the first lookup, so runs without segmentation never load the HTTP stack
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self.session = requests.Session()
+            self.session.headers['User-Agent'] = 'au-2025-chinese-course-a1 flashcard generator'
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=32)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        return self.session
+
+    def has_entries(self, titles):
+        """Returns a dict telling for each title whether it has a Chinese entry."""
+        titles = list(dict.fromkeys(titles))
+        has_entry = {}
+        for i in range(0, len(titles), WiktionaryClient.BATCH_SIZE):
+            has_entry.update(self._query(titles[i:i + WiktionaryClient.BATCH_SIZE]))
+        return has_entry
+
+    def _query(self, titles):
+        parameters = {
+            'action': 'query',
+            'format': 'json',
+            'formatversion': '2',
+            'redirects': '1',
+            'prop': 'categories',
+            'clcategories': '|'.join(WiktionaryClient.CHINESE_CATEGORIES),
+            'cllimit': 'max',
+            'titles': '|'.join(titles),
+        }
+        has_entry = {title: False for title in titles}
+        requested_titles = {title: [title] for title in titles}
+
+        while True:
+            data = self.guard.call(self._get, parameters)
+            query = data.get('query', {})
+
+            # Map normalized and redirected titles back to the requested ones
+            for alias in query.get('normalized', []) + query.get('redirects', []):
+                requested_titles.setdefault(alias['to'], []).extend(requested_titles.get(alias['from'], [alias['from']]))
+
+            for page in query.get('pages', []):
+                if page.get('categories'):
+                    for title in requested_titles.get(page['title'], []):
+                        if title in has_entry:
+                            has_entry[title] = True
+
+            if 'continue' not in data:
+                return has_entry
+            parameters.update(data['continue'])
+
+    def _get(self, parameters):
+        with profiler.time('network.wiktionary'):
+            response = self._get_session().get(self.api_url, params=parameters, timeout=WiktionaryClient.TIMEOUT)
+
+        if response.status_code in THROTTLE_STATUS_CODES:
+            raise ThrottledError(f'Wiktionary responded with {response.status_code}', parse_retry_after(response.headers.get('Retry-After')))
+        response.raise_for_status()
+        return response.json()